@@ -6,8 +6,11 @@ WORKDIR /usr/src/app
 RUN mkdir -p /usr/src/config
 {%- endif %}
 
+# Give numba (used by libraries like librosa) a writable place to cache
+# compiled functions so worker processes don't have to recompile them
 ENV GOOGLE_CLOUD_PROJECT={{klio.pipeline_options.project}} \
-    PYTHONPATH=/usr/src/app
+    PYTHONPATH=/usr/src/app \
+    NUMBA_CACHE_DIR=/tmp/numba_cache
 
 {% if klio.use_fnapi -%}
 RUN pip install --upgrade pip setuptools
@@ -50,4 +53,7 @@ ARG KLIO_CONFIG=klio-job.yaml
 COPY $KLIO_CONFIG /usr/src/config/.effective-klio-job.yaml
 {% else -%}
 RUN pip install .  --use-feature=2020-resolver
-{% endif -%}
+{% endif %}
+# Pre-compile the job's bytecode so containers don't have to on startup
+RUN python -m compileall -q /usr/src/app
+
@@ -13,33 +13,77 @@
 # limitations under the License.
 #
 
+import collections
+import functools
 import json
 import logging
 import os
+import time
 
 import docker
-import emoji
-import requests
 
 from klio_cli.utils import multi_line_terminal_writer
 
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+
+    def _json_loads(raw):
+        # stdlib json only accepts bytes on py3.6+
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        return json.loads(raw)
+
+
+# Docker delimits the JSON objects of its build logs with newlines,
+# usually preceded by a carriage return
+_LOG_DELIMITER = b"\n"
+_CR = ord(b"\r")
+# A build log object that just wraps a newline
+_NOISE_LOG = b'{"stream":"\\n"}'
+# Max number of build log lines to buffer before logging them
+_LOG_FLUSH_LINES = 64
+# Min seconds between writing Docker push progress to the terminal
+_PUSH_FLUSH_SECONDS = 0.05
+# Job directories already confirmed to have a Dockerfile
+_FOUND_DOCKERFILE_DIRS = set()
+
+
+@functools.lru_cache(maxsize=1)
+def _low_level_client():
+    # Connecting to the daemon isn't free, so share one low-level client
+    # between builds
+    return docker.APIClient(base_url="unix://var/run/docker.sock")
+
+
 def check_docker_connection(docker_client):
     try:
         docker_client.ping()
-    except (docker.errors.APIError, requests.exceptions.ConnectionError):
-        logging.error(emoji.emojize("Could not reach Docker! :whale:"))
+    # requests' ConnectionError (raised when the daemon can't be reached)
+    # is an OSError, so there's no need to import requests just to catch it
+    except (docker.errors.DockerException, OSError):
+        logging.error("Could not reach Docker! \N{SPOUTING WHALE}")
         logging.error("Is it installed and running?")
         raise SystemExit(1)
 
 
 def check_dockerfile_present(job_dir):
-    dockerfile_path = job_dir + "/Dockerfile"
-    if not os.path.exists(dockerfile_path):
+    # only remember Dockerfiles that were found, so one added after a
+    # failed check is still picked up
+    if job_dir in _FOUND_DOCKERFILE_DIRS:
+        return
+
+    dockerfile_path = os.path.join(job_dir, "Dockerfile")
+    if not os.path.isfile(dockerfile_path):
         logging.error("Klio can't run job without a Dockerfile.")
         logging.error("Please supply \033[4m{}\033[4m".format(dockerfile_path))
         raise SystemExit(1)
 
+    _FOUND_DOCKERFILE_DIRS.add(job_dir)
+
 
 def docker_image_exists(name, client):
     try:
@@ -74,24 +118,75 @@ def build_docker_image(job_dir, image_name, image_tag, config_file=None):
     """
 
     def clean_logs(log_generator):
-        # Loop through lines containing log JSON objects.
-        # Example line: {"stream":"Starting build..."}\r\n{"stream":"\\n"}\n
-        for line in log_generator:
-            if isinstance(line, bytes):
-                line = line.decode("utf-8")
-            # Some lines contain multiple whitespace-separated objects.
-            # Split them so json.loads doesn't choke.
-            for log_obj in line.split("\r\n"):
-                # Some log objects only wrap newlines.
-                # Split sometimes produces '' char.
-                # Remove these artifacts.
-                if log_obj != '{"stream":"\\n"}' and log_obj != "":
-                    yield log_obj
+        # Loop through chunks containing log JSON objects.
+        # Example chunk: {"stream":"Starting build..."}\r\n{"stream":"\\n"}\n
+        # Some chunks contain multiple objects, ending in either \r\n or \n
+        # (a raw newline never appears inside an object), and an object may
+        # be split across chunks, so scan the raw bytes for newlines and
+        # carry a trailing partial object over to the next chunk. Lines are
+        # kept as bytes since they're handed straight to the JSON parser.
+        # The logs of each chunk are yielded together so they can be
+        # logged before waiting on the next chunk.
+        carry = bytearray()
+        for chunk in log_generator:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode("utf-8")
+            carry += chunk
+            logs = []
+            start = 0
+            with memoryview(carry) as view:
+                end = carry.find(_LOG_DELIMITER, start)
+                while end != -1:
+                    log_end = end
+                    if log_end > start and carry[log_end - 1] == _CR:
+                        log_end -= 1
+                    # Some log objects only wrap newlines, and consecutive
+                    # delimiters produce empty objects. Remove these
+                    # artifacts.
+                    if log_end != start and view[start:log_end] != _NOISE_LOG:
+                        logs.append(_json_loads(view[start:log_end].tobytes()))
+                    start = end + 1
+                    end = carry.find(_LOG_DELIMITER, start)
+            del carry[:start]
+
+            # Docker usually sends one whole object per chunk, so an
+            # unterminated object at the end of a chunk is likely complete;
+            # only carry it over when it doesn't parse yet
+            log_obj = bytes(carry).strip()
+            if not log_obj or log_obj == _NOISE_LOG:
+                del carry[:]
+            else:
+                try:
+                    logs.append(_json_loads(log_obj))
+                except ValueError:
+                    pass
+                else:
+                    del carry[:]
+            yield logs
+
+        log_obj = bytes(carry).strip()
+        if log_obj and log_obj != _NOISE_LOG:
+            yield [_json_loads(log_obj)]
+
+    # Buffer the "stream" lines of a chunk so a noisy build doesn't call
+    # the logger (and take its lock) once per line; emit them together
+    # once enough lines pile up or the chunk is used up, since reading the
+    # next chunk may block until Docker has more output.
+    buffered_lines = []
+
+    def flush_logs():
+        if buffered_lines:
+            logging.info("\n".join(buffered_lines))
+            del buffered_lines[:]
 
     def print_log(log):
         if "stream" in log:
-            logging.info(log["stream"].strip("\n"))
+            line = log["stream"].strip("\n")
+            buffered_lines.append(line)
+            if len(buffered_lines) >= _LOG_FLUSH_LINES:
+                flush_logs()
         if "error" in log:
+            flush_logs()
             fail_color = "\033[91m"
             end_color = "\033[0m"
             logging.info(
@@ -101,7 +196,9 @@ def build_docker_image(job_dir, image_name, image_tag, config_file=None):
             )
             logging.error("\nDocker hit an error while building job image.")
             logging.error(
-                "Please fix your Dockerfile: {}/Dockerfile".format(job_dir)
+                "Please fix your Dockerfile: {}".format(
+                    os.path.join(job_dir, "Dockerfile")
+                )
             )
             raise SystemExit(1)
 
@@ -114,40 +211,58 @@ def build_docker_image(job_dir, image_name, image_tag, config_file=None):
             "KLIO_CONFIG": config_file or "klio-job.yaml",
         },
     }  # Remove intermediate build containers.
-    logs = docker.APIClient(base_url="unix://var/run/docker.sock").build(
-        **build_flag
-    )
+    logs = _low_level_client().build(**build_flag)
 
-    for log_obj in clean_logs(logs):
-        log = json.loads(log_obj)
-        print_log(log)
+    for chunk_logs in clean_logs(logs):
+        for log in chunk_logs:
+            print_log(log)
+        flush_logs()
 
 
 def _get_layer_id_and_message(clean_line):
-    line_json = json.loads(clean_line)
+    line_json = _json_loads(clean_line)
     layer_id = line_json.get("id")
+    # called for every line of push output, so use %-formatting, which
+    # is cheaper than str.format (f-strings aren't available on py3.5)
+    status_and_progress = "%s%s" % (
+        line_json.get("status", ""),
+        line_json.get("progress", ""),
+    )
     # very first log message doesn't have an id
-    msg_pfx = ""
     if layer_id:
-        msg_pfx = "{}: ".format(layer_id)
-    msg = "{prefix}{status}{progress}".format(
-        prefix=msg_pfx,
-        status=line_json.get("status", ""),
-        progress=line_json.get("progress", ""),
-    )
-    return layer_id, msg
+        return layer_id, "%s: %s" % (layer_id, status_and_progress)
+    return layer_id, status_and_progress
 
 
 def push_image_to_gcr(image, tag, client):
     kwargs = {"repository": image, "tag": tag, "stream": True}
     writer = multi_line_terminal_writer.MultiLineTerminalWriter()
+    # Docker sends many progress updates per layer that would only get
+    # overwritten on the terminal right away, so hold on to the latest
+    # message per layer and only write them out every so often.
+    # Ordered so layers are still written in the order they first appear.
+    latest_msgs = collections.OrderedDict()
+    last_flush = time.monotonic()
+
+    def flush_msgs():
+        for layer_id, msg in latest_msgs.items():
+            writer.emit_line(layer_id, msg)
+        latest_msgs.clear()
+
     for raw_line in client.images.push(**kwargs):
-        clean_line = raw_line.decode("utf-8").strip("\r\n")
-        clean_lines = clean_line.split("\r\n")
+        clean_line = raw_line.strip(b"\r\n")
+        clean_lines = clean_line.split(b"\r\n")
 
         for line in clean_lines:
             layer_id, msg = _get_layer_id_and_message(line)
-            writer.emit_line(layer_id, msg.strip())
+            latest_msgs[layer_id] = msg.strip()
+
+        now = time.monotonic()
+        if now - last_flush >= _PUSH_FLUSH_SECONDS:
+            flush_msgs()
+            last_flush = now
+
+    flush_msgs()
 
 
 def get_docker_image_client(job_dir, image_tag, image_name, force_build):
@@ -13,7 +13,6 @@
 # limitations under the License.
 #
 
-import json
 import os
 
 import docker
@@ -32,12 +31,14 @@ def mock_docker_client(mocker):
 
 @pytest.fixture
 def mock_json_loads(mocker):
-    return mocker.patch.object(json, "loads")
+    return mocker.patch.object(docker_utils, "_json_loads")
 
 
 @pytest.fixture
 def mock_docker_api_client(mocker):
-    return mocker.patch.object(docker, "APIClient")
+    docker_utils._low_level_client.cache_clear()
+    yield mocker.patch.object(docker, "APIClient")
+    docker_utils._low_level_client.cache_clear()
 
 
 @pytest.fixture
@@ -65,7 +66,11 @@ def test_check_docker_connection(mock_docker_client):
 
 @pytest.mark.parametrize(
     "error",
-    [docker_errors.APIError("msg"), requests_exceptions.ConnectionError()],
+    [
+        docker_errors.APIError("msg"),
+        docker_errors.DockerException("msg"),
+        requests_exceptions.ConnectionError(),
+    ],
 )
 def test_check_docker_connection_with_errors(
     mock_docker_client, error, caplog
@@ -79,7 +84,8 @@ def test_check_docker_connection_with_errors(
 
 @pytest.mark.parametrize("path_exists", [True, False])
 def test_check_dockerfile_present(monkeypatch, path_exists, caplog):
-    monkeypatch.setattr(os.path, "exists", lambda x: path_exists)
+    monkeypatch.setattr(docker_utils, "_FOUND_DOCKERFILE_DIRS", set())
+    monkeypatch.setattr(os.path, "isfile", lambda x: path_exists)
 
     job_dir = "my/job/dir"
 
@@ -87,8 +93,20 @@ def test_check_dockerfile_present(monkeypatch, path_exists, caplog):
         with pytest.raises(SystemExit):
             docker_utils.check_dockerfile_present(job_dir)
         assert 2 == len(caplog.records)
+        assert job_dir not in docker_utils._FOUND_DOCKERFILE_DIRS
     else:
         docker_utils.check_dockerfile_present(job_dir)
+        assert job_dir in docker_utils._FOUND_DOCKERFILE_DIRS
+
+
+def test_check_dockerfile_present_cached(monkeypatch, mocker):
+    monkeypatch.setattr(docker_utils, "_FOUND_DOCKERFILE_DIRS", set())
+    mock_isfile = mocker.patch.object(os.path, "isfile", return_value=True)
+
+    docker_utils.check_dockerfile_present("my/job/dir")
+    docker_utils.check_dockerfile_present("my/job/dir")
+
+    mock_isfile.assert_called_once_with("my/job/dir/Dockerfile")
 
 
 def test_docker_image_exists(mocker, mock_client):
@@ -189,6 +207,120 @@ def test_build_docker_image(
     assert 2 == len(caplog.records)
 
 
+def test_build_docker_image_split_logs(mocker, mock_docker_api_client, caplog):
+    mock_api_client = mocker.Mock()
+    mock_docker_api_client.return_value = mock_api_client
+    mock_api_client.build.return_value = (
+        item
+        for item in (
+            b'{"stream":"Step 1/2"}\r\n{"stream":"\\n"}\r\n{"str',
+            b'eam":"Step 2/2\\n"}\r\n\r\n',
+            b'{"stream":"Done"}\n',
+        )
+    )
+
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "foobar")
+
+    exp_messages = ["Step 1/2", "Step 2/2", "Done"]
+    assert exp_messages == [r.getMessage() for r in caplog.records]
+
+
+def test_build_docker_image_lf_logs(mocker, mock_docker_api_client, caplog):
+    mock_api_client = mocker.Mock()
+    mock_docker_api_client.return_value = mock_api_client
+    mock_api_client.build.return_value = (
+        item
+        for item in (
+            b'{"stream":"Starting build..."}\r\n{"stream":"\\n"}\n',
+            b'{"stream":"Step 1/2 : FROM x"}\r\n',
+            b'{"stream":"Step 2/2 : RUN x"}\n{"stream":"Done"}\n',
+        )
+    )
+
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "foobar")
+
+    exp_lines = [
+        "Starting build...",
+        "Step 1/2 : FROM x",
+        "Step 2/2 : RUN x",
+        "Done",
+    ]
+    messages = [r.getMessage() for r in caplog.records]
+    assert exp_lines == "\n".join(messages).split("\n")
+
+
+@pytest.mark.parametrize(
+    "flush_lines,exp_messages",
+    (
+        # flush when enough lines are buffered
+        (2, ["0\n1", "2\n3", "4"]),
+        # flush when the chunk is used up
+        (64, ["0\n1\n2\n3\n4"]),
+    ),
+)
+def test_build_docker_image_flush_logs(
+    flush_lines,
+    exp_messages,
+    mocker,
+    monkeypatch,
+    mock_docker_api_client,
+    caplog,
+):
+    monkeypatch.setattr(docker_utils, "_LOG_FLUSH_LINES", flush_lines)
+    mock_api_client = mocker.Mock()
+    mock_docker_api_client.return_value = mock_api_client
+    mock_api_client.build.return_value = [
+        "".join('{{"stream":"{}"}}\r\n'.format(i) for i in range(5))
+    ]
+
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "foobar")
+
+    assert exp_messages == [r.getMessage() for r in caplog.records]
+
+
+def test_build_docker_image_flush_chunk_logs(
+    mocker, mock_docker_api_client, caplog
+):
+    chunks = [
+        '{"stream":"Step 2/3 : RUN pip install foo\\n"}\r\n'
+        '{"stream":" ---> Running in 1234\\n"}\r\n',
+        '{"stream":"Collecting foo\\n"}\r\n',
+        '{"stream":"Installing foo\\n"}\r\n',
+    ]
+    logged = []
+
+    def build_logs():
+        # every chunk is logged before the next one is read (i.e. before
+        # waiting on Docker for more output)
+        for chunk in chunks:
+            yield chunk
+            logged.append([r.getMessage() for r in caplog.records])
+
+    mock_docker_api_client.return_value.build.return_value = build_logs()
+
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "foobar")
+
+    exp_messages = [
+        "Step 2/3 : RUN pip install foo\n ---> Running in 1234",
+        "Collecting foo",
+        "Installing foo",
+    ]
+    assert [exp_messages[:1], exp_messages[:2], exp_messages] == logged
+    assert exp_messages == [r.getMessage() for r in caplog.records]
+
+
+def test_build_docker_image_reuses_client(mocker, mock_docker_api_client):
+    mock_docker_api_client.return_value.build.return_value = []
+
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "foo")
+    docker_utils.build_docker_image("/test/dir", "test-image-name", "bar")
+
+    mock_docker_api_client.assert_called_once_with(
+        base_url="unix://var/run/docker.sock"
+    )
+    assert 2 == mock_docker_api_client.return_value.build.call_count
+
+
 def test_build_docker_image_with_errors(
     mocker, mock_json_loads, mock_docker_api_client, caplog
 ):
@@ -224,7 +356,28 @@ def test_build_docker_image_with_errors(
     assert 3 == len(caplog.records)
 
 
-def test_push_image_to_gcr(mocker, capsys):
+@pytest.mark.parametrize(
+    "line,exp_layer_id,exp_msg",
+    (
+        (
+            b'{"status":"Pushing","progress":"[=>  ]","id":"a1b2"}',
+            "a1b2",
+            "a1b2: Pushing[=>  ]",
+        ),
+        (b'{"status":"Pushed","id":"a1b2"}', "a1b2", "a1b2: Pushed"),
+        (b'{"status":"The push refers to"}', None, "The push refers to"),
+    ),
+)
+def test_get_layer_id_and_message(line, exp_layer_id, exp_msg):
+    layer_id, msg = docker_utils._get_layer_id_and_message(line)
+
+    assert exp_layer_id == layer_id
+    assert exp_msg == msg
+
+
+def test_push_image_to_gcr(mocker, monkeypatch, capsys):
+    # write out every update
+    monkeypatch.setattr(docker_utils, "_PUSH_FLUSH_SECONDS", 0)
     image_name = "my.img.repo"
     tag = "my-tag"
     mock_client = mocker.Mock()
@@ -253,6 +406,27 @@ def test_push_image_to_gcr(mocker, capsys):
     assert exp_stdout == captured.out
 
 
+def test_push_image_to_gcr_coalesces_updates(mocker, monkeypatch, capsys):
+    # nothing gets written out until the push is done
+    monkeypatch.setattr(docker_utils, "_PUSH_FLUSH_SECONDS", 60)
+    mock_client = mocker.Mock()
+    mock_client.images.push.return_value = [
+        b'{"status": "foo"}',
+        b'{"id": "layerid1", "status": "bar", "progress": "some progress"}',
+        b'{"id": "layerid2", "status": "foo", "progress": "other progress"}',
+        b'{"id": "layerid1", "status": "baz", "progress": "more progress"}',
+    ]
+
+    docker_utils.push_image_to_gcr("my.img.repo", "my-tag", mock_client)
+
+    # only the latest update per layer is written, in order of appearance
+    exp_stdout = (
+        "foo\nlayerid1: bazmore progress\nlayerid2: fooother progress\n"
+    )
+    captured = capsys.readouterr()
+    assert exp_stdout == captured.out
+
+
 @pytest.mark.parametrize(
     "docker_image_exists, docker_image_build_raises, check_docker, "
     "check_dockerfile, force_build",
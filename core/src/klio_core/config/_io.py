@@ -342,6 +342,7 @@ class KlioReadAvroConfig(KlioAvroConfig):
     location = attr.attrib(type=str, default=None)
     min_bundle_size = attr.attrib(type=int, default=0)
     validate = attr.attrib(type=bool, default=True)
+    use_binary = attr.attrib(type=bool, default=False)
 
 
 @supports(KlioIODirection.INPUT, KlioIOType.EVENT)
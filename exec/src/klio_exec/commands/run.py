@@ -14,17 +14,15 @@
 #
 
 import collections
-import imp
+import functools
+import importlib.util
 import logging
 import os
-import re
-
-import apache_beam as beam
-from apache_beam.options import pipeline_options
+import string
+import sys
+import types
 
 from klio import __version__ as klio_lib_version
-from klio import transforms
-from klio.transforms import helpers
 from klio_core import __version__ as klio_core_version
 
 from klio_exec import __version__ as klio_exec_version
@@ -39,30 +37,94 @@ DATAFLOW_LABEL_KEY_TO_OS_ENVIRON = {
     "klio-cli": "KLIO_CLI_VERSION",
 }
 
-# Regex according to (https://cloud.google.com/resource-manager/
+# Allowed characters according to (https://cloud.google.com/resource-manager/
 # docs/creating-managing-labels#requirements)
 # otherwise, deployments will fail
-DATAFLOW_LABEL_REGEX = re.compile(r"([a-zA-Z0-9_\-]+)")
+DATAFLOW_LABEL_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
 HERE = os.path.abspath(".")
 
 
+class _LabelValueTranslation(dict):
+    """str.translate table mapping unsupported label characters to a space.
+
+    Lookups are memoized, so non-ASCII characters are handled without
+    having to build a table for all of unicode.
+    """
+
+    def __missing__(self, ordinal):
+        value = ordinal if chr(ordinal) in DATAFLOW_LABEL_CHARS else " "
+        self[ordinal] = value
+        return value
+
+
+_LABEL_VALUE_TRANSLATION = _LabelValueTranslation()
+
+
+_EventIO = collections.namedtuple("_EventIO", ["input", "output"])
+
+
+# NOTE: Apache Beam & klio.transforms are imported when the event IO
+# transforms are first needed rather than at module load, since they're
+# quite expensive to import and not every command launches a pipeline.
+# The mappings are read-only since they're shared by every pipeline.
+@functools.lru_cache(maxsize=None)
+def _get_streaming_event_io():
+    import apache_beam as beam
+
+    return _EventIO(
+        input=types.MappingProxyType({"pubsub": beam.io.ReadFromPubSub}),
+        output=types.MappingProxyType({"pubsub": beam.io.WriteToPubSub}),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_batch_event_io():
+    from klio import transforms
+
+    return _EventIO(
+        input=types.MappingProxyType(
+            {
+                "file": transforms.KlioReadFromText,
+                "bq": transforms.KlioReadFromBigQuery,
+                "avro": transforms.KlioReadFromAvro,
+            }
+        ),
+        output=types.MappingProxyType(
+            {
+                "file": transforms.KlioWriteToText,
+                "bq": transforms.KlioWriteToBigQuery,
+            }
+        ),
+    )
+
+
+# Creating a namedtuple class is relatively expensive, so only create one
+# per unique set of input names
+@functools.lru_cache(maxsize=None)
+def _get_multi_input_pcoll_tuple(input_names):
+    return collections.namedtuple("MultiInputPCollTuple", input_names)
+
+
 # NOTE: hopefully we don't get an dict lookup errors since KlioConfig
 # should raise if given an unsupported event IO transform
 class StreamingEventMapper(object):
-    input = {"pubsub": beam.io.ReadFromPubSub}
-    output = {"pubsub": beam.io.WriteToPubSub}
+    @property
+    def input(self):
+        return _get_streaming_event_io().input
+
+    @property
+    def output(self):
+        return _get_streaming_event_io().output
 
 
 class BatchEventMapper(object):
-    input = {
-        "file": transforms.KlioReadFromText,
-        "bq": transforms.KlioReadFromBigQuery,
-        "avro": transforms.KlioReadFromAvro,
-    }
-    output = {
-        "file": transforms.KlioWriteToText,
-        "bq": transforms.KlioWriteToBigQuery,
-    }
+    @property
+    def input(self):
+        return _get_batch_event_io().input
+
+    @property
+    def output(self):
+        return _get_batch_event_io().output
 
 
 class EventIOMapper(object):
@@ -77,6 +139,7 @@ class KlioPipeline(object):
         self.job_name = job_name
         self.config = config
         self.runtime_conf = runtime_conf
+        self._run_callable = None
         if self.config.pipeline_options.streaming:
             self._io_mapper = event_io_mapper.streaming
         else:
@@ -111,6 +174,8 @@ class KlioPipeline(object):
         return len(self.config.job_config.data.outputs) > 1
 
     def _set_setup_options(self, options):
+        from apache_beam.options import pipeline_options
+
         setup_options = options.view_as(pipeline_options.SetupOptions)
 
         if setup_options.setup_file:
@@ -127,6 +192,8 @@ class KlioPipeline(object):
         pass
 
     def _set_standard_options(self, options):
+        from apache_beam.options import pipeline_options
+
         standard_opts = options.view_as(pipeline_options.StandardOptions)
 
         if self.runtime_conf.direct_runner:
@@ -140,6 +207,7 @@ class KlioPipeline(object):
         return "{}:{}".format(image_name, tag)
 
     def _set_worker_options(self, options):
+        from apache_beam.options import pipeline_options
 
         worker_opts = options.view_as(pipeline_options.WorkerOptions)
 
@@ -155,9 +223,9 @@ class KlioPipeline(object):
 
     @staticmethod
     def _get_clean_label_value(label_value):
-        # Get all regex matches of the label value, replace any unsuppoted
-        # character with "-", and limit to 63 lowercase characters
-        matches = re.findall(DATAFLOW_LABEL_REGEX, label_value)
+        # Replace any run of unsupported characters in the label value
+        # with "-", and limit to 63 lowercase characters
+        matches = label_value.translate(_LABEL_VALUE_TRANSLATION).split()
         if not matches:
             return
         ret_label = "-".join(matches)
@@ -165,6 +233,8 @@ class KlioPipeline(object):
         return ret_label.lower()
 
     def _set_google_cloud_options(self, options):
+        from apache_beam.options import pipeline_options
+
         gcp_opts = options.view_as(pipeline_options.GoogleCloudOptions)
 
         gcp_opts.job_name = self.job_name
@@ -174,28 +244,30 @@ class KlioPipeline(object):
 
         labels = gcp_opts.labels or []
 
-        klio_exec_value = KlioPipeline._get_clean_label_value(
-            klio_exec_version
+        clean_label_value = KlioPipeline._get_clean_label_value
+
+        klio_versions = (
+            ("klio-exec", klio_exec_version),
+            ("klio-core", klio_core_version),
+            ("klio", klio_lib_version),
         )
-        klio_core_value = KlioPipeline._get_clean_label_value(
-            klio_core_version
+        labels.extend(
+            "{}={}".format(label, clean_label_value(version))
+            for label, version in klio_versions
         )
-        klio_value = KlioPipeline._get_clean_label_value(klio_lib_version)
-        klio_labels = [
-            "klio-exec={}".format(klio_exec_value),
-            "klio-core={}".format(klio_core_value),
-            "klio={}".format(klio_value),
-        ]
-
-        labels.extend(klio_labels)
 
         # Dataflow may not be able to handle duplicate keys; we should probably
         # do that here in some fashion (@lynn)
-        for label, os_key in DATAFLOW_LABEL_KEY_TO_OS_ENVIRON.items():
-            os_value = os.environ.get(os_key, "")
-            os_value = KlioPipeline._get_clean_label_value(os_value)
-            if os_value:
-                labels.append("{}={}".format(label, os_value))
+        environ = os.environ
+        os_values = (
+            (label, clean_label_value(environ.get(os_key, "")))
+            for label, os_key in DATAFLOW_LABEL_KEY_TO_OS_ENVIRON.items()
+        )
+        labels.extend(
+            "{}={}".format(label, os_value)
+            for label, os_value in os_values
+            if os_value
+        )
 
         deploy_user = os.environ.get("USER")
         if os.environ.get("CI", "").lower() == "true":
@@ -222,6 +294,8 @@ class KlioPipeline(object):
         return dict((k, v) for k, v in pipe_opts_dict.items() if v is not None)
 
     def _get_pipeline_options(self):
+        from apache_beam.options import pipeline_options
+
         # Remove None values since the from_dictionary sets these as
         # a string 'None' for the PipelineOptions flags.
         config_pipeline_options = self._parse_config_pipeline_options()
@@ -239,9 +313,17 @@ class KlioPipeline(object):
         return options
 
     def _get_run_callable(self):
+        # run.py only needs to be executed once per pipeline, i.e. not again
+        # when retrying to deploy w/o updating
+        if self._run_callable is not None:
+            return self._run_callable
+
         run_path = "./run.py"
         try:
-            run_module = imp.load_source("run", run_path)
+            spec = importlib.util.spec_from_file_location("run", run_path)
+            run_module = importlib.util.module_from_spec(spec)
+            sys.modules["run"] = run_module
+            spec.loader.exec_module(run_module)
             run_basic_callable = getattr(run_module, "run_basic", None)
             run_callable = getattr(run_module, "run", None)
 
@@ -251,7 +333,8 @@ class KlioPipeline(object):
                 )
                 logging.error(msg)
                 raise SystemExit(1)
-            return run_basic_callable if run_basic_callable else run_callable
+            self._run_callable = run_basic_callable or run_callable
+            return self._run_callable
         except (ImportError, IOError):
             logging.error(
                 "Could not import run.py in job {}".format(self.job_name),
@@ -273,6 +356,9 @@ class KlioPipeline(object):
             raise SystemExit(1)
 
     def _setup_data_io_filters(self, in_pcol, label_prefix=None):
+        import apache_beam as beam
+        from klio.transforms import helpers
+
         # label prefixes are required for multiple inputs (to avoid label
         # name collisions in Beam)
         if self._has_multi_data_inputs or self._has_multi_data_outputs:
@@ -346,6 +432,8 @@ class KlioPipeline(object):
         return to_process, to_pass_thru
 
     def _update_audit_log(self, in_pcol, label_pfx=None):
+        from klio.transforms import helpers
+
         label = "Updating KlioMessage Audit Log"
         if label_pfx:
             label = "[{}] {}".format(label_pfx, label)
@@ -353,6 +441,9 @@ class KlioPipeline(object):
         return in_pcol | label >> helpers.KlioUpdateAuditLog()
 
     def _filter_intended_recipients(self, in_pcol, label_pfx=None):
+        import apache_beam as beam
+        from klio.transforms import helpers
+
         pfx = ""
         if label_pfx is not None:
             pfx = "[{}] ".format(label_pfx)
@@ -392,22 +483,26 @@ class KlioPipeline(object):
     # dictionary rather than a list of dicts (@lynn)
     def _generate_input_conf_names(self):
         ev_inputs = self.config.job_config.events.inputs
-        input_dict = {}
-        for index, ev in enumerate(ev_inputs):
-            name = "{}{}".format(ev.name, index)
-            input_dict[name] = ev
-        return input_dict
+        return {
+            "{}{}".format(ev.name, index): ev
+            for index, ev in enumerate(ev_inputs)
+        }
 
     def _generate_pcoll_per_input(self, pipeline):
+        import apache_beam as beam
+
         inputs = self._generate_input_conf_names()
-        MultiInputPCollTuple = collections.namedtuple(
-            "MultiInputPCollTuple", list(inputs.keys())
-        )
+        MultiInputPCollTuple = _get_multi_input_pcoll_tuple(tuple(inputs))
         input_name_to_input_pcolls = {}
         multi_to_pass_thru = []
+        # look up the input transforms once for all inputs
+        input_transforms = self._io_mapper.input
         for input_name, input_conf in inputs.items():
             input_to_process, input_to_pass_thru = self._generate_pcoll(
-                pipeline, input_conf, label_prefix=input_name
+                pipeline,
+                input_conf,
+                label_prefix=input_name,
+                input_transforms=input_transforms,
             )
             if input_to_pass_thru:
                 multi_to_pass_thru.append(input_to_pass_thru)
@@ -420,7 +515,9 @@ class KlioPipeline(object):
         )
         return to_process, to_pass_thru
 
-    def _generate_pcoll(self, pipeline, input_config, label_prefix=None):
+    def _generate_pcoll(
+        self, pipeline, input_config, label_prefix=None, input_transforms=None
+    ):
         to_pass_thru = None
         to_process = pipeline
 
@@ -431,7 +528,9 @@ class KlioPipeline(object):
         if label_prefix:
             label = "[{}] {}".format(label_prefix, label)
 
-        transform_cls_in = self._io_mapper.input[input_config.name]
+        if input_transforms is None:
+            input_transforms = self._io_mapper.input
+        transform_cls_in = input_transforms[input_config.name]
         in_pcol = pipeline | label >> transform_cls_in(
             **input_config.to_io_kwargs()
         )
@@ -444,6 +543,8 @@ class KlioPipeline(object):
 
     # mutates the pipeline object, no need to return it
     def _setup_pipeline(self, pipeline):
+        import apache_beam as beam
+
         run_callable = self._get_run_callable()
 
         to_pass_thru = None
@@ -477,21 +578,21 @@ class KlioPipeline(object):
                     **output_config.to_io_kwargs()
                 )
 
-    def run(self):
-        self._verify_packaging()
+    def _build_pipeline(self):
+        import apache_beam as beam
+        from apache_beam.options import pipeline_options
+
         options = self._get_pipeline_options()
         options.view_as(pipeline_options.SetupOptions).save_main_session = True
 
         pipeline = beam.Pipeline(options=options)
 
         self._setup_pipeline(pipeline)
+        return pipeline
 
+    def _run_pipeline(self, pipeline):
         try:
-            # NOTE: When running with Dataflow, this `result` object has a lot
-            #       of information about the job (id, name, project, status,
-            #       etc). Could be useful if wanting to report back the status,
-            #       URL of the dataflow job, etc.  @lynn
-            result = pipeline.run()
+            return pipeline.run()
         except ValueError as e:
             if (
                 self.runtime_conf.update
@@ -500,12 +601,26 @@ class KlioPipeline(object):
                 # job is currently not running - should simply deploy without
                 # updating set
                 # TODO: is this possible?
+                # Running a pipeline can change its graph and options (i.e.
+                # the Dataflow runner applies its overrides before failing
+                # here), so build a new pipeline rather than reusing it.
+                # With `update` unset, this won't retry more than once.
                 self.runtime_conf = self.runtime_conf._replace(update=None)
-                return self.run()
+                return self._run_pipeline(self._build_pipeline())
 
             logging.error("Error running pipeline: %s" % e)
             raise SystemExit(1)
 
+    def run(self):
+        self._verify_packaging()
+        pipeline = self._build_pipeline()
+
+        # NOTE: When running with Dataflow, this `result` object has a lot
+        #       of information about the job (id, name, project, status,
+        #       etc). Could be useful if wanting to report back the status,
+        #       URL of the dataflow job, etc.  @lynn
+        result = self._run_pipeline(pipeline)
+
         if self.runtime_conf.direct_runner or self.runtime_conf.blocking:
             # the pipeline on direct runner will otherwise get garbage collected
             result.wait_until_finish()
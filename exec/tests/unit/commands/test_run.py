@@ -16,6 +16,7 @@
 import os
 from unittest import mock
 
+import apache_beam as beam
 import pytest
 
 from apache_beam.options import pipeline_options
@@ -139,6 +140,8 @@ patcher = mock.patch(
 )
 patcher.start()
 
+from klio import transforms  # noqa E402
+
 from klio_exec.commands import run  # noqa E402
 
 
@@ -163,36 +166,36 @@ def config():
 
 
 @pytest.mark.parametrize("run_callable", ["run", "run_basic"])
-def test_get_run_callable(monkeypatch, mocker, run_callable):
-    mock_run_module = mocker.Mock()
-    expected_run_callable = mocker.Mock()
-
-    if run_callable == "run":
-        mock_run_module.return_value.run = expected_run_callable
-        mock_run_module.return_value.run_basic = None
-    else:
-        mock_run_module.return_value.run = None
-        mock_run_module.return_value.run_basic = expected_run_callable
-
-    monkeypatch.setattr(run.imp, "load_source", mock_run_module)
+def test_get_run_callable(tmpdir, monkeypatch, mocker, run_callable):
+    job_dir = tmpdir.mkdir("test_job")
+    job_dir.join("run.py").write(
+        "def {}(pipeline, config):\n    return 'called'\n".format(run_callable)
+    )
+    monkeypatch.chdir(job_dir.strpath)
+    monkeypatch.delitem(run.sys.modules, "run", raising=False)
 
     kpipe = run.KlioPipeline("my-job", mocker.Mock(), mocker.Mock())
     actual_callable = kpipe._get_run_callable()
 
-    assert expected_run_callable == actual_callable
-
+    assert run_callable == actual_callable.__name__
+    assert "called" == actual_callable(None, None)
 
-@pytest.mark.parametrize("exception", [None, ImportError, IOError])
-def test_get_run_callable_raises(mocker, monkeypatch, caplog, exception):
-    mock_run_module = mocker.Mock()
+    # run.py is not executed again for the same pipeline
+    job_dir.join("run.py").remove()
+    assert actual_callable == kpipe._get_run_callable()
 
-    if not exception:
-        mock_run_module.return_value.run = None
-        mock_run_module.return_value.run_basic = None
-    else:
-        mock_run_module.side_effect = exception
 
-    monkeypatch.setattr(run.imp, "load_source", mock_run_module)
+@pytest.mark.parametrize(
+    "run_contents", [None, "import not_a_real_module\n", "foo = 1\n"]
+)
+def test_get_run_callable_raises(
+    tmpdir, mocker, monkeypatch, caplog, run_contents
+):
+    job_dir = tmpdir.mkdir("test_job")
+    if run_contents:
+        job_dir.join("run.py").write(run_contents)
+    monkeypatch.chdir(job_dir.strpath)
+    monkeypatch.delitem(run.sys.modules, "run", raising=False)
 
     kpipe = run.KlioPipeline("my-job", mocker.Mock(), mocker.Mock())
 
@@ -216,6 +219,54 @@ def test_get_image_tag(image, tag, expected_image):
     assert expected_image == actual_image
 
 
+@pytest.mark.parametrize(
+    "mapper,exp_input,exp_output",
+    (
+        (
+            run.EventIOMapper.streaming,
+            {"pubsub": beam.io.ReadFromPubSub},
+            {"pubsub": beam.io.WriteToPubSub},
+        ),
+        (
+            run.EventIOMapper.batch,
+            {
+                "file": transforms.KlioReadFromText,
+                "bq": transforms.KlioReadFromBigQuery,
+                "avro": transforms.KlioReadFromAvro,
+            },
+            {
+                "file": transforms.KlioWriteToText,
+                "bq": transforms.KlioWriteToBigQuery,
+            },
+        ),
+    ),
+)
+def test_event_io_mapper(mapper, exp_input, exp_output):
+    assert exp_input == dict(mapper.input)
+    assert exp_output == dict(mapper.output)
+
+    # shared across pipelines, so shouldn't be modifiable
+    with pytest.raises(TypeError):
+        mapper.input["foo"] = "bar"
+
+
+@pytest.mark.parametrize(
+    "label_value,expected_value",
+    (
+        ("0.2.0", "0-2-0"),
+        ("My_Branch--name", "my_branch--name"),
+        ("  feature/foo..bar!  ", "feature-foo-bar"),
+        ("caf\u00e9", "caf"),
+        ("a" * 70, "a" * 63),
+        ("./!", None),
+        ("", None),
+    ),
+)
+def test_get_clean_label_value(label_value, expected_value):
+    actual_value = run.KlioPipeline._get_clean_label_value(label_value)
+    assert expected_value == actual_value
+
+
 @pytest.mark.parametrize(
     "exp,setup_file,requirements_file",
     [
@@ -567,9 +618,7 @@ def test_get_pipeline_options(
         run.KlioPipeline, "_set_setup_options", mock_set_setup_opts
     )
 
-    monkeypatch.setattr(
-        run.pipeline_options, "PipelineOptions", lambda: mock_opts
-    )
+    monkeypatch.setattr(pipeline_options, "PipelineOptions", lambda: mock_opts)
 
     mock_opts_from_dict = mock_opts.from_dictionary.return_value
 
@@ -588,8 +637,41 @@ def test_get_pipeline_options(
     mock_set_setup_opts.assert_called_once_with(mock_opts_from_dict)
 
 
+def test_generate_input_conf_names(config, mocker):
+    mock_pubsub_input = mocker.Mock()
+    mock_pubsub_input.name = "pubsub"
+    mock_file_input = mocker.Mock()
+    mock_file_input.name = "file"
+    config.job_config.events.inputs = [
+        mock_pubsub_input,
+        mock_file_input,
+        mock_pubsub_input,
+    ]
+    kpipe = run.KlioPipeline("test-job", config, mocker.Mock())
+
+    actual = kpipe._generate_input_conf_names()
+
+    expected = {
+        "pubsub0": mock_pubsub_input,
+        "file1": mock_file_input,
+        "pubsub2": mock_pubsub_input,
+    }
+    assert expected == actual
+    # order determines the fields of the tuple passed to the run callable
+    assert list(expected) == list(actual)
+
+
+def test_get_multi_input_pcoll_tuple():
+    pcoll_tuple = run._get_multi_input_pcoll_tuple(("pubsub0", "file1"))
+
+    assert ("pubsub0", "file1") == pcoll_tuple._fields
+    assert pcoll_tuple is run._get_multi_input_pcoll_tuple(
+        ("pubsub0", "file1")
+    )
+
+
 @pytest.mark.parametrize(
-    "direct_runner,run_error,exp_call_count",
+    "direct_runner,run_error,exp_run_count",
     (
         (True, None, 1),
         (False, None, 1),
@@ -603,7 +685,7 @@ def test_run_pipeline(
     blocking,
     direct_runner,
     run_error,
-    exp_call_count,
+    exp_run_count,
     config,
     mocker,
     monkeypatch,
@@ -648,9 +730,9 @@ def test_run_pipeline(
     monkeypatch.setattr(
         run.KlioPipeline, "_get_pipeline_options", mock_get_pipeline_options
     )
-    monkeypatch.setattr(run.beam, "Pipeline", mock_pipeline)
-    monkeypatch.setattr(run.beam.io, "ReadFromPubSub", mock_read_from_pubsub)
-    monkeypatch.setattr(run.beam.io, "WriteToPubSub", mock_write_to_pubsub)
+    monkeypatch.setattr(beam, "Pipeline", mock_pipeline)
+    monkeypatch.setattr(beam.io, "ReadFromPubSub", mock_read_from_pubsub)
+    monkeypatch.setattr(beam.io, "WriteToPubSub", mock_write_to_pubsub)
     if streaming:
         mock_input = mocker.Mock()
         mock_input.name = "pubsub"
@@ -677,29 +759,27 @@ def test_run_pipeline(
 
     kpipe.run()
 
-    assert exp_call_count == mock_verify_packaging.call_count
-    mock_verify_packaging.assert_called_with()
+    # packaging is only verified once, but retrying without update builds
+    # a new pipeline
+    mock_verify_packaging.assert_called_once_with()
 
-    assert exp_call_count == mock_get_run_callable.call_count
+    assert exp_run_count == mock_get_run_callable.call_count
     mock_get_run_callable.assert_called_with()
 
-    assert exp_call_count == mock_get_pipeline_options.call_count
+    assert exp_run_count == mock_get_pipeline_options.call_count
     mock_get_pipeline_options.assert_called_with()
 
-    assert (
-        exp_call_count
-        == mock_get_pipeline_options.return_value.view_as.call_count
-    )
-    mock_get_pipeline_options.return_value.view_as.assert_called_with(
-        pipeline_options.SetupOptions
-    )
+    mock_opts = mock_get_pipeline_options.return_value
+    assert exp_run_count == mock_opts.view_as.call_count
+    mock_opts.view_as.assert_called_with(pipeline_options.SetupOptions)
 
-    assert exp_call_count == mock_pipeline.call_count
-    mock_pipeline.assert_called_with(
-        options=mock_get_pipeline_options.return_value
-    )
+    assert exp_run_count == mock_pipeline.call_count
+    mock_pipeline.assert_called_with(options=mock_opts)
+
+    if run_error:
+        mock_runtime_config._replace.assert_called_once_with(update=None)
 
-    assert exp_call_count == mock_pipeline.return_value.run.call_count
+    assert exp_run_count == mock_pipeline.return_value.run.call_count
 
     if direct_runner or blocking:
         result = mock_pipeline.return_value.run.return_value
@@ -745,13 +825,11 @@ def test_run_pipeline_raises(
     monkeypatch.setattr(
         run.KlioPipeline, "_get_pipeline_options", mock_get_pipeline_options
     )
-    monkeypatch.setattr(run.beam, "Pipeline", mock_pipeline)
-    monkeypatch.setattr(run.beam.io, "ReadFromPubSub", mock_read_from_pubsub)
-    monkeypatch.setattr(
-        run.transforms, "KlioReadFromText", mock_read_from_file
-    )
-    monkeypatch.setattr(run.transforms, "KlioWriteToText", mock_write_to_file)
-    monkeypatch.setattr(run.beam.io, "WriteToPubSub", mock_write_to_pubsub)
+    monkeypatch.setattr(beam, "Pipeline", mock_pipeline)
+    monkeypatch.setattr(beam.io, "ReadFromPubSub", mock_read_from_pubsub)
+    monkeypatch.setattr(transforms, "KlioReadFromText", mock_read_from_file)
+    monkeypatch.setattr(transforms, "KlioWriteToText", mock_write_to_file)
+    monkeypatch.setattr(beam.io, "WriteToPubSub", mock_write_to_pubsub)
     monkeypatch.setattr(
         run.BatchEventMapper, "input", {"file": mock_read_from_file},
     )
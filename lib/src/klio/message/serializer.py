@@ -20,6 +20,19 @@ from klio_core.proto import klio_pb2
 from klio.message import exceptions
 
 
+def _needs_msg_compat(parsed_message):
+    # whether `_handle_msg_compat` would change the given message
+    version = parsed_message.version
+    data = parsed_message.data
+    if version == klio_pb2.Version.V2:
+        return False
+    if version == klio_pb2.Version.V1:
+        return bool(data.entity_id and not data.element)
+    # an unknown version is always updated, unless both the entity ID &
+    # element are set
+    return not (data.entity_id and data.element)
+
+
 def _handle_msg_compat(parsed_message):
     if parsed_message.version is klio_pb2.Version.V1:
         if parsed_message.data.entity_id and not parsed_message.data.element:
@@ -80,9 +93,20 @@ def to_klio_message(incoming_message, kconfig=None, logger=None):
             ``job_config.allow_non_klio_messages`` in ``klio-job.yaml``
             is set to ``False``.
     """
+    parsed_message, _ = _parse_klio_message(incoming_message, kconfig, logger)
+    return parsed_message
+
+
+def _parse_klio_message(incoming_message, kconfig=None, logger=None):
+    # Same as `to_klio_message`, but also returns whether the message is
+    # exactly what was parsed from `incoming_message`, i.e. it wasn't
+    # created from non-KlioMessage bytes nor updated by
+    # `_handle_msg_compat`, and so `incoming_message` can be used as-is
+    # in place of serializing the message again.
     # TODO: when making a generic de/ser func, be sure to assert
     # kconfig and logger exists
     parsed_message = klio_pb2.KlioMessage()
+    unchanged = True
 
     try:
         parsed_message.ParseFromString(incoming_message)
@@ -92,6 +116,7 @@ def to_klio_message(incoming_message, kconfig=None, logger=None):
             # We are assuming that we have been given "raw" data that is not in
             # the form of a serialized KlioMessage.
             parsed_message.data.element = incoming_message
+            unchanged = False
         else:
             logger.error(
                 "Can not parse incoming message. To support non-Klio "
@@ -100,8 +125,10 @@ def to_klio_message(incoming_message, kconfig=None, logger=None):
             )
             raise e
 
+    if unchanged and _needs_msg_compat(parsed_message):
+        unchanged = False
     parsed_message = _handle_msg_compat(parsed_message)
-    return parsed_message
+    return parsed_message, unchanged
 
 
 def _handle_v2_payload(klio_message, payload):
@@ -21,6 +21,10 @@ import apache_beam as beam
 
 from apache_beam import pvalue
 from apache_beam.io.gcp import gcsio
+from apache_beam.io.gcp.internal.clients import storage
+from apache_beam.transforms import window
+from apache_beam.utils import retry
+from apitools.base.py import batch as apitools_batch
 
 from klio.message import serializer
 from klio.transforms import _utils
@@ -54,16 +58,34 @@ class TaggedStates(enum.Enum):
     DEFAULT = "tag_not_set"
 
 
+def _get_incoming_items(dofn):
+    # Maps `id(kmsg)` to the bytes the KlioMessage was parsed from, so
+    # that existence checks - which never mutate the message - can emit
+    # the original bytes rather than serializing the message again, and
+    # to the element's timestamp for batched DoFns (None otherwise).
+    # The bytes are None if parsing changed the message (i.e. it wasn't
+    # a KlioMessage, or it was upgraded for v1 compatibility).
+    # Entries only live as long as the wrapped `process` call.
+    incoming_items = getattr(dofn, "_klio_incoming_items", None)
+    if incoming_items is None:
+        incoming_items = {}
+        dofn._klio_incoming_items = incoming_items
+    return incoming_items
+
+
 # Only serializes to a KlioMessage; we deserialize within the process
 # method itself since we also have to tag the output (too difficult to
 # serialize output that's already tagged)
 def _wrap_process(meth):
     @functools.wraps(meth)
     def wrapper(self, incoming_item, *args, **kwargs):
+        incoming_items = _get_incoming_items(self)
         try:
-            kmsg = serializer.to_klio_message(
+            kmsg, unchanged = serializer._parse_klio_message(
                 incoming_item, self._klio.config, self._klio.logger
             )
+            raw_kmsg = incoming_item if unchanged else None
+            incoming_items[id(kmsg)] = (raw_kmsg, None)
             yield from meth(self, kmsg, *args, **kwargs)
 
         except Exception as err:
@@ -74,9 +96,62 @@ def _wrap_process(meth):
             )
             return
 
+        finally:
+            incoming_items.clear()
+
     return wrapper
 
 
+# Same as `_wrap_process`, but for DoFns that receive a batch of elements
+# (a list of `(element, timestamp)` tuples, via `_with_timestamp` and
+# `beam.BatchElements`). Items that fail to serialize are dropped
+# individually rather than dropping the whole batch.
+def _wrap_process_batch(meth):
+    @functools.wraps(meth)
+    def wrapper(self, incoming_batch, *args, **kwargs):
+        incoming_items = _get_incoming_items(self)
+        kmsgs = []
+        for incoming_item, timestamp in incoming_batch:
+            try:
+                kmsg, unchanged = serializer._parse_klio_message(
+                    incoming_item, self._klio.config, self._klio.logger
+                )
+            except Exception as err:
+                self._klio.logger.error(
+                    "Dropping KlioMessage - exception occurred when "
+                    "serializing '%s' to a KlioMessage.\nError: %s"
+                    % (incoming_item, err),
+                    exc_info=True,
+                )
+                continue
+            raw_kmsg = incoming_item if unchanged else None
+            incoming_items[id(kmsg)] = (raw_kmsg, timestamp)
+            kmsgs.append(kmsg)
+
+        try:
+            yield from meth(self, kmsgs, *args, **kwargs)
+
+        except Exception as err:
+            self._klio.logger.error(
+                "Dropping %d KlioMessage(s) - exception occurred when "
+                "processing batch.\nError: %s" % (len(kmsgs), err),
+                exc_info=True,
+            )
+            return
+
+        finally:
+            incoming_items.clear()
+
+    return wrapper
+
+
+# Batches are emitted with a single timestamp (the minimum timestamp for
+# whatever is left over at the end of a bundle in the global window), so
+# keep each element's own timestamp to re-stamp its output with.
+def _with_timestamp(element, timestamp=beam.DoFn.TimestampParam):
+    return element, timestamp
+
+
 def _job_in_jobs(current_job, job_list):
     # Use job name & project to ensure uniqueness
     curr_job_name = "{}-{}".format(
@@ -89,23 +164,46 @@ def _job_in_jobs(current_job, job_list):
     return curr_job_name in downstream_job_names
 
 
+_KLIO_CONTEXT = None
+
+
+def _get_klio_context():
+    # All state on a KlioContext is thread-local except for the
+    # transform name, so one context can be shared by every class
+    global _KLIO_CONTEXT
+    if _KLIO_CONTEXT is None:
+        _KLIO_CONTEXT = core.KlioContext()
+    return _KLIO_CONTEXT
+
+
 class _KlioBaseDoFnMetaclass(type):
     """Enforce behavior upon subclasses of `_KlioBaseDataExistenceCheck`."""
 
     def __init__(cls, name, bases, clsdict):
         if not getattr(cls, "_klio", None):
-            setattr(cls, "_klio", core.KlioContext())
+            setattr(cls, "_klio", _get_klio_context())
 
         if os.getenv("KLIO_TEST_MODE", "").lower() in ("true", "1"):
             return
 
+        # no need to introspect classes that don't define their own
+        # `process`, or whose `process` we've already wrapped
+        process = clsdict.get("process")
+        if process is None or getattr(process, "__klio_wrapped__", False):
+            return
+
         # TODO: fixme: not every child class will inherit from
         # _KlioBaseDataExistenceCheck
         if _utils.is_original_process_func(
             clsdict, bases, base_class="_KlioBaseDataExistenceCheck"
         ):
+            wrap_process = _wrap_process
+            if getattr(cls, "BATCHED", False) is True:
+                wrap_process = _wrap_process_batch
 
-            setattr(cls, "process", _wrap_process(clsdict["process"]))
+            wrapped_process = wrap_process(process)
+            wrapped_process.__klio_wrapped__ = True
+            setattr(cls, "process", wrapped_process)
 
             cls._klio._transform_name = name
 
@@ -115,13 +213,23 @@ class _KlioBaseDoFnMetaclass(type):
         # `pcoll | KlioInputDataExistenceCheck()` rather than
         # `pcoll | beam.ParDo(KlioInputDataExistenceCheck()).with_outputs()`
         if self.WITH_OUTPUTS is True:
-            return beam.ParDo(
+            transform = beam.ParDo(
                 super(_KlioBaseDoFnMetaclass, self).__call__(*args, **kwargs)
             ).with_outputs()
+        else:
+            transform = beam.ParDo(
+                super(_KlioBaseDoFnMetaclass, self).__call__(*args, **kwargs)
+            )
 
-        return beam.ParDo(
-            super(_KlioBaseDoFnMetaclass, self).__call__(*args, **kwargs)
-        )
+        # batched DoFns receive lists of elements rather than one at a time
+        if getattr(self, "BATCHED", False) is True:
+            batch_elements = beam.BatchElements(
+                min_batch_size=self.MIN_BATCH_SIZE,
+                max_batch_size=self.MAX_BATCH_SIZE,
+            )
+            return beam.Map(_with_timestamp) | batch_elements | transform
+
+        return transform
 
 
 class _KlioBaseDataExistenceCheck(beam.DoFn, metaclass=_KlioBaseDoFnMetaclass):
@@ -129,6 +237,11 @@ class _KlioBaseDataExistenceCheck(beam.DoFn, metaclass=_KlioBaseDoFnMetaclass):
 
     DIRECTION_PFX = None  # i.e. KlioIODirection.INPUT
     WITH_OUTPUTS = True
+    # whether `process` receives a list of elements (batched with
+    # `beam.BatchElements`) rather than a single element
+    BATCHED = False
+    MIN_BATCH_SIZE = 64
+    MAX_BATCH_SIZE = 1024
 
     @property
     def _location(self):
@@ -150,6 +263,37 @@ class _KlioBaseDataExistenceCheck(beam.DoFn, metaclass=_KlioBaseDoFnMetaclass):
             self._location, element.decode("utf-8") + self._suffix
         )
 
+    def _tag_existence(self, kmsg, item_path, item_exists):
+        state = DataExistState.FOUND
+        if not item_exists:
+            state = DataExistState.NOT_FOUND
+
+        self._klio.logger.info(
+            "%s %s at %s"
+            % (
+                self.DIRECTION_PFX.value.title(),
+                DataExistState.to_str(state),
+                item_path,
+            )
+        )
+
+        # the message isn't changed by checking for existence, so pass
+        # through the bytes it came in as (if parsing didn't change it)
+        # rather than re-serializing it
+        raw_kmsg, timestamp = _get_incoming_items(self).get(
+            id(kmsg), (None, None)
+        )
+        if not isinstance(raw_kmsg, bytes):
+            raw_kmsg = kmsg.SerializeToString()
+
+        # batched elements get their own timestamp back rather than the
+        # timestamp of the batch they were in
+        if timestamp is not None:
+            raw_kmsg = window.TimestampedValue(raw_kmsg, timestamp)
+
+        # double tag for easier user interface, i.e. pcoll.found vs pcoll.true
+        return pvalue.TaggedOutput(state.value, raw_kmsg)
+
 
 class _KlioInputDataMixin(object):
     """Mixin to add input-specific logic for a data existence check.
@@ -237,29 +381,108 @@ class _KlioGcsDataExistsMixin(object):
     def exists(self, path):
         return self.client.exists(path)
 
+    def exists_batch(self, paths):
+        """Check if multiple GCS paths exist via batched requests.
+
+        Args:
+            paths (list(str)): GCS paths to check.
+        Returns:
+            (list) whether or not each path exists (``bool``), or the
+                exception raised checking it, in the same order as
+                ``paths``.
+        """
+        # modeled after `gcsio.GcsIO.delete_batch`, which supports
+        # batching deletes, but not gets
+        paths_exist = []
+        batch_size = gcsio.MAX_BATCH_OPERATION_SIZE
+        for start in range(0, len(paths), batch_size):
+            end = start + batch_size
+            paths_chunk = paths[start:end]
+            batch_request = apitools_batch.BatchApiRequest(
+                batch_url=gcsio.GCS_BATCH_ENDPOINT,
+                retryable_codes=retry.SERVER_ERROR_OR_TIMEOUT_CODES,
+                response_encoding="utf-8",
+            )
+            for path in paths_chunk:
+                bucket, object_path = gcsio.parse_gcs_path(path)
+                request = storage.StorageObjectsGetRequest(
+                    bucket=bucket, object=object_path
+                )
+                batch_request.Add(self.client.client.objects, "Get", request)
+
+            api_calls = batch_request.Execute(self.client.client._http)
+            for api_call in api_calls:
+                if not api_call.is_error:
+                    paths_exist.append(True)
+                elif getattr(api_call.exception, "status_code", None) == 404:
+                    paths_exist.append(False)
+                else:
+                    paths_exist.append(api_call.exception)
+
+        return paths_exist
+
 
 class _KlioGcsCheckExistsBase(
     _KlioGcsDataExistsMixin, _KlioBaseDataExistenceCheck
 ):
-    """Must be used with either _KlioInputDataMixin or _KlioOutputDataMixin"""
+    """Must be used with either _KlioInputDataMixin or _KlioOutputDataMixin
+
+    Checks existence one element at a time; see
+    `_KlioGcsCheckExistsBatchedBase` for checking batches of elements.
+    """
 
     def process(self, kmsg):
         item = kmsg.data.element
         item_path = self._get_absolute_path(item)
         item_exists = self.exists(item_path)
 
-        state = DataExistState.FOUND
-        if not item_exists:
-            state = DataExistState.NOT_FOUND
+        yield self._tag_existence(kmsg, item_path, item_exists)
 
-        self._klio.logger.info(
-            "%s %s at %s"
-            % (
-                self.DIRECTION_PFX.value.title(),
-                DataExistState.to_str(state),
-                item_path,
+
+class _KlioGcsCheckExistsBatchedBase(
+    _KlioGcsDataExistsMixin, _KlioBaseDataExistenceCheck
+):
+    """Must be used with either _KlioInputDataMixin or _KlioOutputDataMixin
+
+    Checks existence of a batch of elements with batched GCS requests
+    rather than one request per element.
+    """
+
+    BATCHED = True
+
+    def _exists_each(self, paths):
+        paths_exist = []
+        for path in paths:
+            try:
+                paths_exist.append(self.exists(path))
+            except Exception as err:
+                paths_exist.append(err)
+        return paths_exist
+
+    def process(self, kmsgs):
+        item_paths = [
+            self._get_absolute_path(kmsg.data.element) for kmsg in kmsgs
+        ]
+        try:
+            paths_exist = self.exists_batch(item_paths)
+        except Exception as err:
+            # the batch request itself failed; check each path on its own
+            # so that only the elements that can't be checked get dropped
+            self._klio.logger.warning(
+                "Batched existence check failed, checking %d path(s) one "
+                "at a time.\nError: %s" % (len(item_paths), err)
             )
-        )
+            paths_exist = self._exists_each(item_paths)
 
-        # double tag for easier user interface, i.e. pcoll.found vs pcoll.true
-        yield pvalue.TaggedOutput(state.value, kmsg.SerializeToString())
+        for kmsg, item_path, item_exists in zip(
+            kmsgs, item_paths, paths_exist
+        ):
+            if isinstance(item_exists, Exception):
+                self._klio.logger.error(
+                    "Dropping KlioMessage - exception occurred when "
+                    "checking existence of '%s'.\nError: %s"
+                    % (item_path, item_exists),
+                    exc_info=item_exists,
+                )
+                continue
+            yield self._tag_existence(kmsg, item_path, item_exists)
@@ -42,6 +42,30 @@ class KlioGcsCheckOutputExists(
     pass
 
 
+class KlioGcsCheckInputExistsBatched(
+    _helpers._KlioInputDataMixin, _helpers._KlioGcsCheckExistsBatchedBase
+):
+    """Klio transform to check input exists in GCS, in batches.
+
+    Same as :class:`KlioGcsCheckInputExists`, but elements are grouped
+    with ``beam.BatchElements`` and checked with batched GCS requests.
+    """
+
+    pass
+
+
+class KlioGcsCheckOutputExistsBatched(
+    _helpers._KlioOutputDataMixin, _helpers._KlioGcsCheckExistsBatchedBase
+):
+    """Klio transform to check output exists in GCS, in batches.
+
+    Same as :class:`KlioGcsCheckOutputExists`, but elements are grouped
+    with ``beam.BatchElements`` and checked with batched GCS requests.
+    """
+
+    pass
+
+
 class KlioFilterPing(
     _helpers._KlioInputDataMixin, _helpers._KlioBaseDataExistenceCheck
 ):
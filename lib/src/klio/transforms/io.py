@@ -13,18 +13,213 @@
 # limitations under the License.
 #
 
+import functools
+import io
 import json
-import os
+import logging
+import queue
+import sys
+import threading
 
 import apache_beam as beam
+import fastavro
 
+from apache_beam import coders
 from apache_beam.io import avroio as beam_avroio
+from apache_beam.io import filesystems
 from apache_beam.io.gcp import bigquery as beam_bq
 from apache_beam.io.gcp import bigquery_tools as beam_bq_tools
+from google.protobuf.internal import api_implementation
+from google.protobuf.internal import encoder as pb_encoder
+from google.protobuf.internal import wire_format as pb_wire_format
 
 from klio_core.proto import klio_pb2
 
 
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+
+    def _json_dumps(obj):
+        # match orjson's output byte for byte, so a message's element
+        # doesn't depend on whether orjson is installed
+        return json.dumps(
+            obj, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+
+    def _json_loads(raw):
+        # stdlib json only accepts bytes on py3.6+
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        return json.loads(raw)
+
+
+# Every record read or written by these transforms is (de)serialized as a
+# KlioMessage, which is a lot slower with protobuf's pure-Python backend.
+# By the time this module is imported protobuf has already been loaded,
+# so the backend can't be changed from here; just make it visible.
+if api_implementation.Type() == "python":
+    logging.getLogger("klio").warning(
+        "Using the pure-Python protobuf implementation, which will slow "
+        "down reading and writing KlioMessages. Install a protobuf "
+        "release with C++ (or upb) support for the current platform to "
+        "speed this up."
+    )
+
+
+# How far ahead of the pipeline file-based sources read: records are
+# handed over in batches (to keep the cost of the queue down for small
+# records like lines of text), with at most this many batches waiting.
+# On top of the waiting batches, the reading thread fills one more batch
+# and the pipeline works through another, so up to
+# (max_batches + 2) * batch_size records are held in memory: 96 for text.
+_PREFETCH_BATCH_SIZE = 16
+_PREFETCH_MAX_BATCHES = 4
+# Avro records (i.e. audio) can be large, so only read a single record
+# ahead of the one being processed, holding at most 3 in memory.
+_AVRO_PREFETCH_BATCH_SIZE = 1
+_AVRO_PREFETCH_MAX_BATCHES = 1
+_PREFETCH_DONE = object()
+
+
+def _prefetch(
+    records, batch_size=_PREFETCH_BATCH_SIZE, max_batches=_PREFETCH_MAX_BATCHES
+):
+    """Read ``records`` from another thread while they're being processed.
+
+    Reading from GCS (and decoding) a file's records otherwise only
+    happens once the previous record has made its way through the
+    pipeline, so the two are done one after the other rather than at
+    the same time.
+
+    Args:
+        records (iterable): records to read, e.g. as returned by a
+            source's ``read_records``.
+        batch_size (int): number of records handed over at a time.
+        max_batches (int): number of batches to read ahead.
+    Returns:
+        (generator) the same records, in the same order. Errors raised
+        while reading are re-raised here.
+    """
+    batches = queue.Queue(maxsize=max_batches)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if nothing is reading anymore (i.e. the generator below
+        # has been closed) rather than blocking forever on a full queue
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        records_iter = iter(records)
+        batch = []
+        try:
+            for record in records_iter:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(_PREFETCH_DONE)
+        except Exception as e:
+            # hand over what was read before the error first
+            if not batch or put(batch):
+                put(e)
+        finally:
+            # make sure the file gets closed from the thread reading it
+            close = getattr(records_iter, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=read, name="KlioPrefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _PREFETCH_DONE:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for record in batch:
+                yield record
+    finally:
+        stop.set()
+
+
+def _get_element_serializer(message):
+    """Get a function serializing ``message`` with a different element.
+
+    The read transforms create messages that only differ in their
+    ``data.element``. Rather than setting the element on a message and
+    serializing the whole message for every record, serialize the rest
+    of ``message`` once and only encode the ``data.element`` field for
+    each record. The output is the same as ``SerializeToString``.
+
+    Args:
+        message (klio_pb2.KlioMessage): the message to use for all
+            records; its ``data`` must be empty.
+    Returns:
+        (function) taking the element (bytes) and returning the
+        serialized message (bytes).
+    """
+    # Fields are serialized in order of their field number: metadata (1),
+    # data (2), then version (3). Data only has its element set, so
+    # everything around it stays the same.
+    fields = klio_pb2.KlioMessage.DESCRIPTOR.fields_by_name
+    data_fields = klio_pb2.KlioMessage.Data.DESCRIPTOR.fields_by_name
+
+    # passing `metadata` always marks it as set, even when it's empty
+    prefix = b""
+    if message.HasField("metadata"):
+        prefix = klio_pb2.KlioMessage(
+            metadata=message.metadata
+        ).SerializePartialToString()
+    suffix = klio_pb2.KlioMessage(
+        version=message.version
+    ).SerializePartialToString()
+    data_tag = pb_encoder.TagBytes(
+        fields["data"].number, pb_wire_format.WIRETYPE_LENGTH_DELIMITED
+    )
+    element_tag = pb_encoder.TagBytes(
+        data_fields["element"].number, pb_wire_format.WIRETYPE_LENGTH_DELIMITED
+    )
+    # proto3 leaves out empty fields, but data is still set
+    empty = prefix + data_tag + pb_encoder._VarintBytes(0) + suffix
+    varint = pb_encoder._VarintBytes
+    join = b"".join
+    element_tag_size = len(element_tag)
+
+    def serialize(element):
+        size = len(element)
+        if not size:
+            return empty
+        size_bytes = varint(size)
+        data_size = element_tag_size + len(size_bytes) + size
+        return join(
+            (
+                prefix,
+                data_tag,
+                varint(data_size),
+                element_tag,
+                size_bytes,
+                element,
+                suffix,
+            )
+        )
+
+    return serialize
+
+
 class BaseKlioIOException(Exception):
     """Base IO exception."""
 
@@ -81,13 +276,23 @@ class _KlioWrapIOMetaclass(type):
         return super(_KlioWrapIOMetaclass, self).__call__(*args, **kwargs)
 
 
-class _KlioTransformMixin(metaclass=_KlioWrapIOMetaclass):
+class _KlioTransformMixin(object):
     """Common properties for klio v2 IO transforms."""
 
     # whether or not the transform needs to be invoked by beam.io.Read()
     _REQUIRES_IO_READ_WRAP = False
 
 
+# Only transforms that need wrapping go through the metaclass, so that
+# the rest are instantiated like any other class. Note: wrapping can't
+# be done in `__new__` instead, since pickling (i.e. when Beam ships the
+# source to workers) re-creates instances through `__new__` too.
+class _KlioReadWrapMixin(_KlioTransformMixin, metaclass=_KlioWrapIOMetaclass):
+    """Common properties for klio v2 IO transforms wrapped in Read()."""
+
+    _REQUIRES_IO_READ_WRAP = True
+
+
 class _KlioReadFromTextSource(beam.io.textio._TextSource):
     """Parses a text file as newline-delimited elements.
        Supports newline delimiters '\n' and '\r\n
@@ -96,18 +301,33 @@ class _KlioReadFromTextSource(beam.io.textio._TextSource):
         (str) KlioMessage serialized as a string
     """
 
+    def __init__(self, *args, **kwargs):
+        super(_KlioReadFromTextSource, self).__init__(*args, **kwargs)
+        # Lines end up as bytes in `KlioMessage.data.element`, so rather
+        # than decoding them with the default coder only to encode them
+        # again, read them as bytes.
+        if isinstance(self._coder, coders.StrUtf8Coder):
+            self._coder = coders.BytesCoder()
+
     def read_records(self, file_name, range_tracker):
-        records = super(_KlioReadFromTextSource, self).read_records(
-            file_name, range_tracker
+        records = _prefetch(
+            super(_KlioReadFromTextSource, self).read_records(
+                file_name, range_tracker
+            )
         )
+        # a custom coder may still give us strings
+        encode_records = not isinstance(self._coder, coders.BytesCoder)
 
+        # Everything but the element stays the same for every record, so
+        # only serialize the rest of the message once
+        message = klio_pb2.KlioMessage()
+        message.version = klio_pb2.Version.V2
+        message.metadata.intended_recipients.anyone.SetInParent()
+        serialize = _get_element_serializer(message)
         for record in records:
-            record_as_bytes = record.encode("utf-8")
-            message = klio_pb2.KlioMessage()
-            message.version = klio_pb2.Version.V2
-            message.metadata.intended_recipients.anyone.SetInParent()
-            message.data.element = record_as_bytes
-            yield message.SerializeToString()
+            if encode_records:
+                record = record.encode("utf-8")
+            yield serialize(record)
 
 
 class KlioReadFromText(beam.io.ReadFromText, _KlioTransformMixin):
@@ -119,10 +339,36 @@ class KlioReadFromText(beam.io.ReadFromText, _KlioTransformMixin):
 
 
 class _KlioBigQueryReader(beam_bq_tools.BigQueryReader):
+    # Setting up a BigQuery API client (credentials and an HTTP
+    # connection) is done for every reader by default. httplib2
+    # connections aren't thread-safe, so rather than one client for the
+    # whole worker, each thread keeps its own client that is shared by
+    # all of the readers it creates.
+    _clients = threading.local()
+
     def __init__(self, *args, klio_message_columns=None, **kwargs):
         super(_KlioBigQueryReader, self).__init__(*args, **kwargs)
+        # interned (and kept as a tuple) so that looking them up in each
+        # row's dict can match on identity, which a dict lookup checks
+        # before comparing strings, whenever the row's keys are too
+        if klio_message_columns:
+            klio_message_columns = tuple(
+                sys.intern(col) for col in klio_message_columns
+            )
         self.__klio_message_columns = klio_message_columns
 
+    def __get_client(self):
+        client = getattr(self._clients, "client", None)
+        if client is None:
+            client = beam_bq_tools.BigQueryWrapper().client
+            self._clients.client = client
+        return client
+
+    def __enter__(self):
+        if self.test_bigquery_client is None:
+            self.test_bigquery_client = self.__get_client()
+        return super(_KlioBigQueryReader, self).__enter__()
+
     def __generate_klio_message(self):
         message = klio_pb2.KlioMessage()
         message.version = klio_pb2.Version.V2
@@ -142,6 +388,41 @@ class _KlioBigQueryReader(beam_bq_tools.BigQueryReader):
         # Potentially.
         return message
 
+    @staticmethod
+    def __value_to_bytes(value):
+        # a single column's value is used as-is when possible, without
+        # going through JSON
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode("utf-8")
+        return _json_dumps(value)
+
+    def __get_row_to_element(self):
+        # Which columns to use doesn't change between rows, so pick how
+        # to convert a row once rather than checking for every row
+        columns = self.__klio_message_columns
+        if not columns:
+            return _json_dumps
+
+        if len(columns) == 1:
+            column = columns[0]
+            value_to_bytes = self.__value_to_bytes
+
+            def row_to_element(row):
+                return value_to_bytes(row[column])
+
+        else:
+
+            def row_to_element(row):
+                # only look up the requested columns rather than
+                # scanning every column of the row
+                return _json_dumps(
+                    {col: row[col] for col in columns if col in row}
+                )
+
+        return row_to_element
+
     def __iter__(self):
         # NOTE: this assumes that the coder being used (default is
         # beam.io.gcp.bigquery_tools.RowAsDictJsonCoder, otherwise set in
@@ -149,36 +430,31 @@ class _KlioBigQueryReader(beam_bq_tools.BigQueryReader):
         # a plain dictionary). This assumption might break if someone
         # provides a different coder.
         # NOTE: We need to have the row elements be bytes, so if it is
-        # a dictionary, we json.dumps into a str to convert to bytes,
-        # but that may need to change if we want to support other coders
+        # a dictionary, we dump it to JSON as bytes, but that may need to
+        # change if we want to support other coders
+        # Only the element differs between rows (see
+        # `_KlioReadFromTextSource.read_records`)
+        serialize = _get_element_serializer(self.__generate_klio_message())
+        row_to_element = self.__get_row_to_element()
         for row in super(_KlioBigQueryReader, self).__iter__():
-            message = self.__generate_klio_message()
-
-            data = {}
-            if self.__klio_message_columns:
-                if len(self.__klio_message_columns) == 1:
-                    data = row[self.__klio_message_columns[0]]
-
-                else:
-                    for key, value in row.items():
-                        if key in self.__klio_message_columns:
-                            data[key] = value
-                    data = json.dumps(data)
-
-            else:
-                data = json.dumps(row)
-
-            message.data.element = bytes(data, "utf-8")
-            yield message.SerializeToString()
+            yield serialize(row_to_element(row))
 
 
 # Note: copy-pasting the docstrings of `BigQuerySource` so that we can
 # include our added parameter (`klio_message_columns`) in the API
 # documentation (via autodoc). If we don't do this, then just the parent
 # documentation will be shown, excluding our new parameter.
-class KlioReadFromBigQuery(beam_bq.BigQuerySource, _KlioTransformMixin):
+class KlioReadFromBigQuery(beam_bq.BigQuerySource, _KlioReadWrapMixin):
     """Read from BigQuery with each row as a ``KlioMessage.data.element``.
 
+    .. note::
+
+        Rows are read via an export of the table or query results
+        (``BigQuerySource``). Reading via the BigQuery Storage API
+        (``ReadFromBigQuery`` with ``method=DIRECT_READ``, which would
+        only fetch ``klio_message_columns``) requires a newer version of
+        Apache Beam than the 2.22 - 2.24 releases Klio currently supports.
+
     Args:
       table (str): The ID of a BigQuery table. If specified all data of the
         table will be used as input of the current source. The ID must contain
@@ -201,7 +477,8 @@ class KlioReadFromBigQuery(beam_bq.BigQuerySource, _KlioTransformMixin):
             column names will be serialized to JSON before assigning to
             ``KlioMessage.data.element``. (e.g. ``'{"field1": "foo",
             "field2": bar"}'``). If only one field is provided, just the
-            value will be assigned to ``KlioMessage.data.element``.
+            value will be assigned to ``KlioMessage.data.element``
+            (values that aren't strings or bytes are serialized to JSON).
 
       query (str): A query to be used instead of arguments table, dataset, and
         project.
@@ -256,10 +533,16 @@ class KlioWriteToBigQuery(beam.io.WriteToBigQuery, _KlioTransformMixin):
 
     _REQUIRES_IO_READ_WRAP = False
 
-    def __unwrap(self, encoded_element):
+    # A staticmethod so that Beam only has to pickle the function for the
+    # Map step below, not this whole transform along with it. Note that
+    # the payload can't be handed to the sink as-is: streaming inserts
+    # build the API request's JSON objects from dicts, and file loads
+    # need dicts for their own row writers, so it has to be loaded here.
+    @staticmethod
+    def __unwrap(encoded_element):
         message = klio_pb2.KlioMessage()
         message.ParseFromString(encoded_element)
-        data = json.loads(message.data.payload)
+        data = _json_loads(message.data.payload)
 
         return data
 
@@ -273,6 +556,11 @@ class _KlioTextSink(beam.io.textio._TextSink):
        and writes the elements to a textfile
     """
 
+    # One message per thread (created lazily on workers, and not pickled
+    # with the sink) to parse records into: the sink is shared by all of
+    # the writers made from it, which may be writing at the same time.
+    _messages = threading.local()
+
     def write_record(self, file_handle, encoded_element):
         """Writes a single encoded record.
         Args:
@@ -280,10 +568,17 @@ class _KlioTextSink(beam.io.textio._TextSink):
                 audio file found in the configured output data location.
             encoded_element (KlioMessage): KlioMessage
         """
-        message = klio_pb2.KlioMessage()
+        # reuse one message to parse every record into rather than
+        # creating a new one per record; `ParseFromString` clears out
+        # the previous record first
+        message = getattr(self._messages, "message", None)
+        if message is None:
+            message = klio_pb2.KlioMessage()
+            self._messages.message = message
         message.ParseFromString(encoded_element)
-        record = message.data.element
-        super(_KlioTextSink, self).write_encoded_record(file_handle, record)
+        # `write_encoded_record` isn't overridden here, so skip creating a
+        # `super` proxy for every record
+        self.write_encoded_record(file_handle, message.data.element)
 
 
 class KlioWriteToText(beam.io.textio.WriteToText):
@@ -295,18 +590,60 @@ class KlioWriteToText(beam.io.textio.WriteToText):
         self._sink = _KlioTextSink(*args, **kwargs)
 
 
+# Every split of a file needs the file's schema; cache it so the header
+# is only read once per file rather than once per split
+@functools.lru_cache(maxsize=128)
+def _get_avro_schema(file_name, compression_type):
+    # see `FileBasedSource.open_file`
+    with filesystems.FileSystems.open(
+        file_name,
+        "application/octet-stream",
+        compression_type=compression_type,
+    ) as f:
+        writer_schema = fastavro.block_reader(f).writer_schema
+    return fastavro.parse_schema(writer_schema)
+
+
 # note: fast avro is default for py3 on beam
 class _KlioFastAvroSource(beam_avroio._FastAvroSource):
+    def __init__(self, *args, use_binary=False, **kwargs):
+        super(_KlioFastAvroSource, self).__init__(*args, **kwargs)
+        self._use_binary = use_binary
+
+    def _get_record_encoder(self, file_name):
+        if not self._use_binary:
+            return _json_dumps
+
+        # records are re-encoded with the schema they were written with,
+        # which is in the file's header
+        schema = _get_avro_schema(file_name, self._compression_type)
+        write = fastavro.schemaless_writer
+        buf = io.BytesIO()
+
+        def encode(record):
+            buf.seek(0)
+            buf.truncate()
+            write(buf, schema, record)
+            return buf.getvalue()
+
+        return encode
+
     def read_records(self, file_name, range_tracker):
-        records = super(_KlioFastAvroSource, self).read_records(
-            file_name=file_name, range_tracker=range_tracker
+        records = _prefetch(
+            super(_KlioFastAvroSource, self).read_records(
+                file_name=file_name, range_tracker=range_tracker
+            ),
+            batch_size=_AVRO_PREFETCH_BATCH_SIZE,
+            max_batches=_AVRO_PREFETCH_MAX_BATCHES,
         )
+        # see `_KlioReadFromTextSource.read_records`
+        message = klio_pb2.KlioMessage()
+        message.version = klio_pb2.Version.V2
+        message.metadata.intended_recipients.anyone.SetInParent()
+        serialize = _get_element_serializer(message)
+        encode = self._get_record_encoder(file_name)
         for record in records:
-            message = klio_pb2.KlioMessage()
-            message.version = klio_pb2.Version.V2
-            message.metadata.intended_recipients.anyone.SetInParent()
-            message.data.element = bytes(json.dumps(record).encode("utf-8"))
-            yield message.SerializeToString()
+            yield serialize(encode(record))
 
 
 # define an I/O transform using the klio-specific avro source
@@ -321,7 +658,7 @@ class KlioReadFromAvro(beam.io.ReadFromAvro):
     """Read avro from a local directory or GCS bucket.
 
     Data from avro is dumped into JSON and assigned to ``KlioMessage.data.
-    element``.
+    element``, unless ``use_binary`` is set.
 
     Args:
       file_pattern (str): the file glob to read.
@@ -330,6 +667,12 @@ class KlioReadFromAvro(beam.io.ReadFromAvro):
         splitting the input into bundles.
       validate (bool): flag to verify that the files exist during the pipeline
         creation time.
+      use_binary (bool): assign each record to ``KlioMessage.data.element``
+        Avro-encoded (without a schema, as with
+        ``fastavro.schemaless_writer``) rather than as JSON. This keeps
+        the record's types and skips JSON encoding. Decode with the
+        writer schema of the files being read, i.e. with
+        ``fastavro.schemaless_reader``.
     """
 
     _REQUIRES_IO_READ_WRAP = True
@@ -340,6 +683,7 @@ class KlioReadFromAvro(beam.io.ReadFromAvro):
         location=None,
         min_bundle_size=0,
         validate=True,
+        use_binary=False,
     ):
         file_pattern = self._get_file_pattern(file_pattern, location)
 
@@ -351,21 +695,28 @@ class KlioReadFromAvro(beam.io.ReadFromAvro):
         )
 
         self._source = _KlioFastAvroSource(
-            file_pattern, min_bundle_size, validate=validate
+            file_pattern,
+            min_bundle_size,
+            validate=validate,
+            use_binary=use_binary,
         )
 
     def _get_file_pattern(self, file_pattern, location):
         # TODO: this should be a validator in klio_core.config
-        if not any([file_pattern, location]):
+        if not (file_pattern or location):
             raise KlioMissingConfiguration(
                 "Must configure at least one of the following keys when "
                 "reading from avro: `file_pattern`, `location`."
             )
 
-        if all([file_pattern, location]):
-            file_pattern = os.path.join(location, file_pattern)
+        if file_pattern and location:
+            # locations are GCS URIs or local POSIX paths, so there's no
+            # need for os.path; the pattern is always relative to location
+            file_pattern = "/".join(
+                (location.rstrip("/"), file_pattern.lstrip("/"))
+            )
 
-        elif file_pattern is None:
+        elif not file_pattern:
             file_pattern = location
 
         return file_pattern
@@ -114,6 +114,50 @@ def test_to_klio_message_allow_non_kmsg(klio_config, logger, monkeypatch):
     logger.error.assert_not_called()
 
 
+@pytest.mark.parametrize(
+    "version,element,entity_id,exp_unchanged",
+    (
+        (klio_pb2.Version.V2, b"an-element", None, True),
+        (klio_pb2.Version.V1, None, "an-entity-id", False),
+        (klio_pb2.Version.V1, b"an-element", "an-entity-id", True),
+        (klio_pb2.Version.UNKNOWN, b"an-element", None, False),
+        (klio_pb2.Version.UNKNOWN, None, "an-entity-id", False),
+        (klio_pb2.Version.UNKNOWN, None, None, False),
+        (klio_pb2.Version.UNKNOWN, b"an-element", "an-entity-id", True),
+    ),
+)
+def test_parse_klio_message(
+    version, element, entity_id, exp_unchanged, klio_config, logger
+):
+    msg = klio_pb2.KlioMessage()
+    msg.version = version
+    if element:
+        msg.data.element = element
+    if entity_id:
+        msg.data.entity_id = entity_id
+    incoming = msg.SerializeToString()
+
+    actual_message, actual_unchanged = serializer._parse_klio_message(
+        incoming, klio_config, logger
+    )
+
+    assert exp_unchanged is actual_unchanged
+    # unchanged means the incoming bytes can stand in for the message
+    assert exp_unchanged is (incoming == actual_message.SerializeToString())
+
+
+def test_parse_klio_message_non_kmsg(klio_config, logger, monkeypatch):
+    monkeypatch.setattr(
+        klio_config.job_config, "allow_non_klio_messages", True
+    )
+
+    _, actual_unchanged = serializer._parse_klio_message(
+        b"Not a klio message", klio_config, logger
+    )
+
+    assert actual_unchanged is False
+
+
 def test_to_klio_message_raises(klio_config, logger, monkeypatch):
     incoming = b"Not a klio message"
 
@@ -18,9 +18,13 @@ import pytest
 
 from apache_beam.options import pipeline_options
 from apache_beam.testing import test_pipeline
+from apache_beam.testing import util as btest_util
+from apache_beam.transforms import window
+from apache_beam.utils.timestamp import Timestamp
 
 from klio_core.proto import klio_pb2
 
+from klio.transforms import _helpers
 from klio.transforms import helpers
 
 
@@ -444,3 +448,211 @@ def test_trigger_upstream_job(mock_config, mocker):
         mock_pubsub_client.return_value.topic_path.return_value,
         exp_kmsg.SerializeToString(),
     )
+
+
+def _with_timestamp(element, timestamp=beam.DoFn.TimestampParam):
+    return element, timestamp
+
+
+def test_gcs_check_input_exists_batched(mock_config, mocker):
+    mocker.patch("klio.transforms._helpers.gcsio.GcsIO")
+    mock_exists_batch = mocker.patch.object(
+        _helpers._KlioGcsDataExistsMixin, "exists_batch"
+    )
+    mock_exists_batch.side_effect = lambda paths: [
+        path.endswith("-found") for path in paths
+    ]
+
+    elements = [b"foo-found", b"bar-missing", b"baz-found"]
+    kmsgs = []
+    for element in elements:
+        kmsg = klio_pb2.KlioMessage()
+        kmsg.version = klio_pb2.Version.V2
+        kmsg.data.element = element
+        kmsgs.append(kmsg.SerializeToString())
+    timestamps = [10, 20, 30]
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = (
+            p
+            | beam.Create(list(zip(kmsgs, timestamps)))
+            | beam.Map(lambda e: window.TimestampedValue(*e))
+        )
+        input_data = in_pcol | helpers.KlioGcsCheckInputExistsBatched()
+
+        # each output keeps the timestamp of its own element
+        btest_util.assert_that(
+            input_data.found | "found ts" >> beam.Map(_with_timestamp),
+            btest_util.equal_to(
+                [(kmsgs[0], Timestamp(10)), (kmsgs[2], Timestamp(30))]
+            ),
+            label="assert found",
+        )
+        btest_util.assert_that(
+            input_data.not_found | "not found ts" >> beam.Map(_with_timestamp),
+            btest_util.equal_to([(kmsgs[1], Timestamp(20))]),
+            label="assert not found",
+        )
+
+    # all elements fit within one batch
+    mock_exists_batch.assert_called_once()
+    exp_paths = [
+        "gs://hopefully-this-bucket-doesnt-exist/" + e.decode("utf-8")
+        for e in elements
+    ]
+    assert sorted(exp_paths) == sorted(mock_exists_batch.call_args[0][0])
+
+
+def _non_canonical_v2_kmsg():
+    # version (field 3) before data (field 2) - a valid KlioMessage, but
+    # not how protobuf would serialize it, so emitting these bytes as-is
+    # can be told apart from serializing the message again
+    version = klio_pb2.KlioMessage()
+    version.version = klio_pb2.Version.V2
+    data = klio_pb2.KlioMessage()
+    data.data.element = b"foo"
+    return version.SerializeToString() + data.SerializeToString()
+
+
+def _v1_kmsg():
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.data.entity_id = "foo"
+    return kmsg.SerializeToString()
+
+
+def _upgraded_v1_kmsg():
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.version = klio_pb2.Version.V1
+    kmsg.data.entity_id = "foo"
+    kmsg.data.element = b"foo"
+    return kmsg.SerializeToString()
+
+
+def _wrapped_non_kmsg():
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.version = klio_pb2.Version.V2
+    kmsg.data.element = b"Not a klio message"
+    return kmsg.SerializeToString()
+
+
+@pytest.mark.parametrize(
+    "raw_kmsg,exp_kmsg",
+    (
+        # passed through untouched when parsing doesn't change the message
+        (_non_canonical_v2_kmsg(), _non_canonical_v2_kmsg()),
+        # otherwise the parsed (and updated) message is emitted
+        (_v1_kmsg(), _upgraded_v1_kmsg()),
+        (b"Not a klio message", _wrapped_non_kmsg()),
+    ),
+)
+def test_gcs_check_input_exists_passes_thru_bytes(
+    raw_kmsg, exp_kmsg, mock_config, mocker
+):
+    mock_gcs_client = mocker.patch("klio.transforms._helpers.gcsio.GcsIO")
+    mock_gcs_client.return_value.exists.return_value = True
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create([raw_kmsg])
+        input_data = in_pcol | helpers.KlioGcsCheckInputExists()
+
+        btest_util.assert_that(
+            input_data.found, btest_util.equal_to([exp_kmsg])
+        )
+
+
+def test_gcs_exists_batch(mocker, monkeypatch):
+    monkeypatch.setattr(_helpers.gcsio, "MAX_BATCH_OPERATION_SIZE", 2)
+    mock_batch_request = mocker.patch.object(
+        _helpers.apitools_batch, "BatchApiRequest"
+    )
+    found_call = mocker.Mock(is_error=False)
+    not_found_call = mocker.Mock(is_error=True)
+    not_found_call.exception.status_code = 404
+    mock_batch_request.return_value.Execute.side_effect = [
+        [found_call, not_found_call],
+        [found_call],
+    ]
+
+    exists_check = _helpers._KlioGcsDataExistsMixin()
+    exists_check.client = mocker.Mock()
+    paths = ["gs://bucket/found", "gs://bucket/not-found", "gs://bucket/two"]
+
+    actual = exists_check.exists_batch(paths)
+
+    assert [True, False, True] == actual
+    # requests are chunked by gcsio.MAX_BATCH_OPERATION_SIZE
+    assert 2 == mock_batch_request.return_value.Execute.call_count
+    assert 3 == mock_batch_request.return_value.Add.call_count
+
+
+def test_gcs_exists_batch_errors(mocker):
+    mock_batch_request = mocker.patch.object(
+        _helpers.apitools_batch, "BatchApiRequest"
+    )
+    found_call = mocker.Mock(is_error=False)
+    error_call = mocker.Mock(is_error=True)
+    error_call.exception = RuntimeError("Internal Server Error")
+    mock_batch_request.return_value.Execute.return_value = [
+        error_call,
+        found_call,
+    ]
+
+    exists_check = _helpers._KlioGcsDataExistsMixin()
+    exists_check.client = mocker.Mock()
+
+    actual = exists_check.exists_batch(["gs://bucket/foo", "gs://bucket/bar"])
+
+    # errors are returned per path rather than failing the whole batch
+    assert [error_call.exception, True] == actual
+
+
+@pytest.mark.parametrize("batch_fails", (True, False))
+def test_gcs_check_exists_batched_drops_per_element(
+    batch_fails, mock_config, mocker, caplog
+):
+    mock_gcs_client = mocker.patch("klio.transforms._helpers.gcsio.GcsIO")
+    mock_exists_batch = mocker.patch.object(
+        _helpers._KlioGcsDataExistsMixin, "exists_batch"
+    )
+    error = RuntimeError("Internal Server Error")
+    if batch_fails:
+        mock_exists_batch.side_effect = RuntimeError("Batch failed")
+        mock_gcs_client.return_value.exists.side_effect = [True, error]
+    else:
+        mock_exists_batch.return_value = [True, error]
+
+    kmsgs = []
+    for element in (b"foo", b"bar"):
+        kmsg = klio_pb2.KlioMessage()
+        kmsg.version = klio_pb2.Version.V2
+        kmsg.data.element = element
+        kmsgs.append(kmsg.SerializeToString())
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create(kmsgs)
+        input_data = in_pcol | helpers.KlioGcsCheckInputExistsBatched()
+
+        # only the element that couldn't be checked is dropped
+        btest_util.assert_that(
+            input_data.found, btest_util.equal_to([kmsgs[0]]),
+        )
+
+    exp_log = "Dropping KlioMessage - exception occurred when checking"
+    assert any(exp_log in rec.message for rec in caplog.records)
+
+
+def test_base_dofn_metaclass_wraps_process_once():
+    class CheckExists(_helpers._KlioBaseDataExistenceCheck):
+        def process(self, kmsg):
+            yield kmsg
+
+    assert CheckExists.process.__klio_wrapped__ is True
+    assert CheckExists._klio is _helpers._get_klio_context()
+
+    # reusing an already-wrapped `process` shouldn't wrap it again
+    wrapped_process = CheckExists.process
+
+    class AnotherCheckExists(_helpers._KlioBaseDataExistenceCheck):
+        process = wrapped_process
+
+    assert AnotherCheckExists.process is wrapped_process
@@ -14,12 +14,18 @@
 #
 
 import glob
+import io
 import json
 import os
 import tempfile
+import threading
+import time
 
 import apache_beam as beam
+import fastavro
+import pytest
 
+from apache_beam.io import range_trackers
 from apache_beam.testing import test_pipeline
 
 from klio_core.proto import klio_pb2
@@ -52,6 +58,40 @@ def test_read_from_file():
     assert transform._REQUIRES_IO_READ_WRAP is False
 
 
+class _UpperCaseStrCoder(beam.coders.Coder):
+    def decode(self, encoded):
+        return encoded.decode("utf-8").upper()
+
+
+@pytest.mark.parametrize(
+    "coder,exp_transform",
+    (
+        (None, lambda line: line),
+        (_UpperCaseStrCoder(), lambda line: line.upper()),
+    ),
+)
+def test_read_from_text_source(coder, exp_transform):
+    file_path = os.path.join(FIXTURE_PATH, "elements_text_file.txt")
+    kwargs = {}
+    if coder is not None:
+        kwargs["coder"] = coder
+
+    source = io_transforms.KlioReadFromText(file_path, **kwargs)._source
+    range_tracker = range_trackers.OffsetRangeTracker(
+        0, range_trackers.OffsetRangeTracker.OFFSET_INFINITY
+    )
+    records = source.read_records(file_path, range_tracker)
+
+    with open(file_path, "rb") as f:
+        exp_elements = [exp_transform(line.rstrip(b"\n")) for line in f]
+    actual_elements = []
+    for record in records:
+        message = klio_pb2.KlioMessage()
+        message.ParseFromString(record)
+        actual_elements.append(message.data.element)
+    assert exp_elements == actual_elements
+
+
 def test_write_to_file():
     file_path_read = os.path.join(FIXTURE_PATH, "elements_text_file.txt")
 
@@ -75,25 +115,68 @@ def test_write_to_file():
         assert write_results == read_results
 
 
+def test_klio_text_sink_write_record(tmpdir):
+    sink = io_transforms._KlioTextSink(tmpdir.strpath)
+    file_handle = io.BytesIO()
+
+    for element in (b"s0m3-1d", b"4n0th3r-1d"):
+        message = klio_pb2.KlioMessage()
+        message.data.element = element
+        message.data.payload = b"some payload"
+        sink.write_record(file_handle, message.SerializeToString())
+
+    assert b"s0m3-1d\n4n0th3r-1d\n" == file_handle.getvalue()
+
+
+def test_klio_text_sink_write_record_threads(tmpdir):
+    sink = io_transforms._KlioTextSink(tmpdir.strpath)
+    elements = {
+        name: [name + str(i).encode("utf-8") for i in range(500)]
+        for name in (b"a", b"b", b"c")
+    }
+    file_handles = {name: io.BytesIO() for name in elements}
+
+    def write(name):
+        for element in elements[name]:
+            message = klio_pb2.KlioMessage()
+            message.data.element = element
+            sink.write_record(file_handles[name], message.SerializeToString())
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in elements]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # concurrent writers don't share the message records are parsed into
+    for name, element_list in elements.items():
+        exp = b"".join(e + b"\n" for e in element_list)
+        assert exp == file_handles[name].getvalue()
+
+
+AVRO_RECORDS = [
+    {
+        "username": "miguno",
+        "tweet": "Rock: Nerf paper, scissors is fine.",
+        "timestamp": 1366150681,
+    },
+    {
+        "username": "BlizzardCS",
+        "tweet": "Works as intended.  Terran is IMBA.",
+        "timestamp": 1366154481,
+    },
+]
+
+
 def _expected_avro_kmsgs():
-    expected_records = [
-        {
-            "username": "miguno",
-            "tweet": "Rock: Nerf paper, scissors is fine.",
-            "timestamp": 1366150681,
-        },
-        {
-            "username": "BlizzardCS",
-            "tweet": "Works as intended.  Terran is IMBA.",
-            "timestamp": 1366154481,
-        },
-    ]
     expected_kmsgs = []
-    for record in expected_records:
+    for record in AVRO_RECORDS:
         message = klio_pb2.KlioMessage()
         message.version = klio_pb2.Version.V2
         message.metadata.intended_recipients.anyone.SetInParent()
-        message.data.element = bytes(json.dumps(record).encode("utf-8"))
+        message.data.element = json.dumps(
+            record, separators=(",", ":")
+        ).encode("utf-8")
         expected_kmsgs.append(message)
     return expected_kmsgs
 
@@ -116,3 +199,294 @@ def test_read_from_avro():
         )
 
     assert io_transforms.KlioReadFromAvro._REQUIRES_IO_READ_WRAP is True
+
+
+def test_read_from_avro_use_binary():
+    file_pattern = os.path.join(FIXTURE_PATH, "twitter.avro")
+    with open(file_pattern, "rb") as f:
+        schema = fastavro.reader(f).writer_schema
+
+    def assert_expected_binary_klio_msg(element):
+        message = klio_pb2.KlioMessage()
+        message.ParseFromString(element)
+        record = fastavro.schemaless_reader(
+            io.BytesIO(message.data.element), schema
+        )
+        assert record in AVRO_RECORDS
+
+    with test_pipeline.TestPipeline() as p:
+        (
+            p
+            | io_transforms.KlioReadFromAvro(
+                file_pattern=file_pattern, use_binary=True
+            )
+            | beam.Map(assert_expected_binary_klio_msg)
+        )
+
+
+def test_get_avro_schema(mocker):
+    file_name = os.path.join(FIXTURE_PATH, "twitter.avro")
+    with open(file_name, "rb") as f:
+        exp_schema = fastavro.parse_schema(fastavro.reader(f).writer_schema)
+    io_transforms._get_avro_schema.cache_clear()
+    spy_open = mocker.spy(io_transforms.filesystems.FileSystems, "open")
+
+    # e.g. one call per split of the same file
+    for _ in range(3):
+        schema = io_transforms._get_avro_schema(file_name, "auto")
+        assert exp_schema == schema
+
+    assert 1 == spy_open.call_count
+
+
+@pytest.mark.parametrize(
+    "file_pattern,location,exp_file_pattern",
+    (
+        ("*.avro", None, "*.avro"),
+        (None, "gs://a-bucket/avro", "gs://a-bucket/avro"),
+        ("", "gs://a-bucket/avro", "gs://a-bucket/avro"),
+        ("*.avro", "gs://a-bucket/avro", "gs://a-bucket/avro/*.avro"),
+        ("*.avro", "gs://a-bucket/avro/", "gs://a-bucket/avro/*.avro"),
+        ("/*.avro", "/local/avro/", "/local/avro/*.avro"),
+    ),
+)
+def test_read_from_avro_get_file_pattern(
+    file_pattern, location, exp_file_pattern
+):
+    get_file_pattern = io_transforms.KlioReadFromAvro._get_file_pattern
+
+    assert exp_file_pattern == get_file_pattern(None, file_pattern, location)
+
+
+@pytest.mark.parametrize("file_pattern,location", ((None, None), ("", "")))
+def test_read_from_avro_get_file_pattern_raises(file_pattern, location):
+    get_file_pattern = io_transforms.KlioReadFromAvro._get_file_pattern
+
+    with pytest.raises(io_transforms.KlioMissingConfiguration):
+        get_file_pattern(None, file_pattern, location)
+
+
+BQ_ROW = {"entity_id": "s0m3-1d", "count": 1, "score": 0.5}
+
+
+@pytest.mark.parametrize(
+    "row,klio_message_columns,exp_element",
+    (
+        (BQ_ROW, None, b'{"entity_id":"s0m3-1d","count":1,"score":0.5}'),
+        (
+            BQ_ROW,
+            ["entity_id", "count"],
+            b'{"entity_id":"s0m3-1d","count":1}',
+        ),
+        # keys follow the order of the configured columns; missing
+        # columns are skipped
+        (
+            BQ_ROW,
+            ["score", "entity_id", "missing"],
+            b'{"score":0.5,"entity_id":"s0m3-1d"}',
+        ),
+        (BQ_ROW, ["entity_id"], b"s0m3-1d"),
+        (BQ_ROW, ["count"], b"1"),
+        ({"entity_id": b"s0m3-1d"}, ["entity_id"], b"s0m3-1d"),
+    ),
+)
+def test_klio_bigquery_reader(row, klio_message_columns, exp_element, mocker):
+    mocker.patch.object(
+        io_transforms.beam_bq_tools.BigQueryReader,
+        "__init__",
+        return_value=None,
+    )
+    mocker.patch.object(
+        io_transforms.beam_bq_tools.BigQueryReader,
+        "__iter__",
+        lambda self: iter([row, row]),
+    )
+
+    reader = io_transforms._KlioBigQueryReader(
+        klio_message_columns=klio_message_columns
+    )
+
+    actual = list(reader)
+
+    exp_message = klio_pb2.KlioMessage()
+    exp_message.version = klio_pb2.Version.V2
+    exp_message.metadata.intended_recipients.anyone.SetInParent()
+    exp_message.data.element = exp_element
+    assert [exp_message.SerializeToString()] * 2 == actual
+
+
+def test_klio_bigquery_reader_shares_client(mocker, monkeypatch):
+    mocker.patch.object(
+        io_transforms.beam_bq_tools.BigQueryReader,
+        "__init__",
+        return_value=None,
+    )
+    mock_enter = mocker.patch.object(
+        io_transforms.beam_bq_tools.BigQueryReader, "__enter__", create=True,
+    )
+    mock_wrapper = mocker.patch.object(
+        io_transforms.beam_bq_tools, "BigQueryWrapper"
+    )
+    monkeypatch.setattr(
+        io_transforms._KlioBigQueryReader,
+        "_clients",
+        io_transforms.threading.local(),
+    )
+
+    readers = []
+    for _ in range(2):
+        reader = io_transforms._KlioBigQueryReader()
+        reader.test_bigquery_client = None
+        reader.__enter__()
+        readers.append(reader)
+
+    mock_wrapper.assert_called_once_with()
+    exp_client = mock_wrapper.return_value.client
+    assert all(r.test_bigquery_client is exp_client for r in readers)
+    assert 2 == mock_enter.call_count
+
+    # a client given explicitly (i.e. in tests) is left alone
+    reader = io_transforms._KlioBigQueryReader()
+    reader.test_bigquery_client = mocker.sentinel.client
+    reader.__enter__()
+    assert mocker.sentinel.client is reader.test_bigquery_client
+
+
+@pytest.mark.parametrize(
+    "obj,exp_dumped",
+    (
+        (BQ_ROW, b'{"entity_id":"s0m3-1d","count":1,"score":0.5}'),
+        (["caf\u00e9", None, True], b'["caf\xc3\xa9",null,true]'),
+    ),
+)
+def test_json_dumps(obj, exp_dumped):
+    # same bytes whether or not orjson is installed
+    assert exp_dumped == io_transforms._json_dumps(obj)
+
+
+def test_klio_write_to_bigquery_unwrap():
+    message = klio_pb2.KlioMessage()
+    message.data.payload = b'{"entity_id":"s0m3-1d","count":1,"score":0.5}'
+
+    unwrap = io_transforms.KlioWriteToBigQuery._KlioWriteToBigQuery__unwrap
+    actual = unwrap(message.SerializeToString())
+
+    assert BQ_ROW == actual
+
+
+@pytest.mark.parametrize("count", (0, 1, 16, 100))
+def test_prefetch(count):
+    records = list(range(count))
+
+    actual = list(io_transforms._prefetch(iter(records), batch_size=16))
+
+    assert records == actual
+
+
+@pytest.mark.parametrize(
+    "batch_size,max_batches",
+    (
+        (
+            io_transforms._PREFETCH_BATCH_SIZE,
+            io_transforms._PREFETCH_MAX_BATCHES,
+        ),
+        (
+            io_transforms._AVRO_PREFETCH_BATCH_SIZE,
+            io_transforms._AVRO_PREFETCH_MAX_BATCHES,
+        ),
+    ),
+)
+def test_prefetch_reads_ahead(batch_size, max_batches):
+    read = []
+
+    def records():
+        while True:
+            read.append(1)
+            yield len(read)
+
+    prefetched = io_transforms._prefetch(
+        records(), batch_size=batch_size, max_batches=max_batches
+    )
+    assert 1 == next(prefetched)
+    # give the reading thread time to fill up the queue
+    time.sleep(0.2)
+
+    assert (max_batches + 2) * batch_size >= len(read)
+    prefetched.close()
+
+
+def test_read_from_avro_prefetch(mocker):
+    mock_prefetch = mocker.patch.object(
+        io_transforms, "_prefetch", return_value=iter([])
+    )
+    source = io_transforms._KlioFastAvroSource("*.avro", validate=False)
+
+    assert [] == list(source.read_records("a.avro", None))
+    mock_prefetch.assert_called_once_with(
+        mocker.ANY,
+        batch_size=io_transforms._AVRO_PREFETCH_BATCH_SIZE,
+        max_batches=io_transforms._AVRO_PREFETCH_MAX_BATCHES,
+    )
+
+
+def test_prefetch_raises():
+    def records():
+        yield 1
+        raise ValueError("boom")
+
+    actual = []
+    with pytest.raises(ValueError, match="boom"):
+        for record in io_transforms._prefetch(records()):
+            actual.append(record)
+
+    assert [1] == actual
+
+
+def test_prefetch_closes_records():
+    closed = threading.Event()
+
+    def records():
+        try:
+            while True:
+                yield 1
+        finally:
+            closed.set()
+
+    prefetched = io_transforms._prefetch(records(), batch_size=1)
+    assert 1 == next(prefetched)
+    prefetched.close()
+
+    assert closed.wait(timeout=5)
+
+
+@pytest.mark.parametrize(
+    "element", (b"", b"s0m3-1d", b"a" * 127, b"a" * 128, b"a" * 2 ** 16)
+)
+@pytest.mark.parametrize("version", (None, klio_pb2.Version.V2))
+@pytest.mark.parametrize("with_metadata", (True, False))
+def test_get_element_serializer(element, version, with_metadata):
+    message = klio_pb2.KlioMessage()
+    if version is not None:
+        message.version = version
+    if with_metadata:
+        message.metadata.intended_recipients.anyone.SetInParent()
+
+    serialize = io_transforms._get_element_serializer(message)
+    actual = serialize(element)
+
+    message.data.element = element
+    assert message.SerializeToString() == actual
+
+
+def test_klio_read_wrap(mocker):
+    mocker.patch.object(
+        io_transforms.beam_bq.BigQuerySource, "__init__", return_value=None
+    )
+
+    transform = io_transforms.KlioReadFromBigQuery(table="a:b.c")
+
+    assert isinstance(transform, io_transforms._KlioReadWrapper)
+    assert isinstance(transform.source, io_transforms.KlioReadFromBigQuery)
+    # transforms that aren't wrapped don't go through the metaclass
+    assert type is type(io_transforms.KlioReadFromText)
+    assert type is type(io_transforms.KlioWriteToBigQuery)